@@ -54,6 +54,7 @@ class Editor:
         self.tile_variant = 0
 
         self.clicking = False
+        self.last_placed_tile = None
         self.right_clicking = False
         self.shift = False
         self.ctrl = False
@@ -79,8 +80,8 @@ class Editor:
             if self.keep_rotating:
                 self.rotation = (self.rotation + 5) % 360
 
-            current_tile_img = self.assets[self.tile_list[self.tile_group]][self.tile_variant].copy()
-            current_tile_img = pygame.transform.rotate(current_tile_img, self.rotation)
+            current_tile_img = self.tilemap.tile_images.get(
+                self.tile_list[self.tile_group], self.tile_variant, self.rotation).copy()
             current_tile_img.set_alpha(125)
 
             # if a spawner is currently selected then reset all tile settings
@@ -111,27 +112,19 @@ class Editor:
             self.display.blit(mpos_text_surf, mpos_text_rect)
 
             if self.clicking and self.ongrid:
-                self.tilemap.tilemap[f"{tile_pos[0]};{tile_pos[1]}"] = {
-                    'type': self.tile_list[self.tile_group],
-                    'variant': self.tile_variant,
-                    'pos': tile_pos,
-                    'rotation': self.rotation,
-                }
+                placed_tile = (tile_pos, self.tile_list[self.tile_group], self.tile_variant, self.rotation)
+                # placing the same tile again every frame would undo the autotiling of it
+                if placed_tile != self.last_placed_tile:
+                    self.tilemap.set_tile(tile_pos[0], tile_pos[1], *placed_tile[1:])
+                    self.last_placed_tile = placed_tile
+            else:
+                self.last_placed_tile = None
             if self.right_clicking:
-                tile_loc = f"{tile_pos[0]};{tile_pos[1]}"
-                if tile_loc in self.tilemap.tilemap:
-                    del self.tilemap.tilemap[tile_loc]
-                else:
+                if not self.tilemap.remove_tile(*tile_pos):
+                    world_pos = (mpos[0] + self.scroll[0], mpos[1] + self.scroll[1])
                     for offgrid_map in (self.tilemap.offgrid_tiles, self.tilemap.offgrid_hover_tiles):
-                        for tile in offgrid_map:
-                            tile_img = self.assets[tile['type']][tile['variant']]
-                            tile_r = pygame.Rect(
-                                tile['pos'][0] - self.scroll[0],
-                                tile['pos'][1] - self.scroll[1],
-                                tile_img.get_width(),
-                                tile_img.get_height())
-                            if tile_r.collidepoint(mpos):
-                                offgrid_map.remove(tile)
+                        for tile in offgrid_map.at(world_pos):
+                            offgrid_map.remove(tile)
 
             self.display.blit(current_tile_img, (5, 5))
 
@@ -243,4 +236,5 @@ class Editor:
             self.clock.tick(60)
 
 
-Editor().run()
+if __name__ == '__main__':
+    Editor().run()
@@ -0,0 +1,75 @@
+import argparse
+import json
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from scripts.world import World, load_assets, LEFT, RIGHT, JUMP, DASH
+
+# assets are loaded once per worker process and shared by every world it runs
+_assets = None
+
+
+def random_inputs(rng, frames):
+    """ Input vectors of a player mashing buttons: held directions that change now and then, random jumps and dashes """
+    held = [0, 0]
+    for frame in range(frames):
+        if rng.random() < 0.03:
+            held = [0, 0]
+            held[rng.randrange(2)] = 1 if rng.random() < 0.8 else 0
+        inputs = [0, 0, 0, 0]
+        inputs[LEFT], inputs[RIGHT] = held
+        inputs[JUMP] = rng.random() < 0.02
+        inputs[DASH] = rng.random() < 0.01
+        yield inputs
+
+
+def run_world(job):
+    """ Plays one world through headless, job is (level, seed, frames) """
+    global _assets
+    level, seed, frames = job
+    if _assets is None:
+        _assets = load_assets()
+
+    start = time.perf_counter()
+    world = World(_assets, level_number=level, seed=seed)
+    for inputs in random_inputs(random.Random(seed), frames):
+        world.step(inputs)
+    seconds = time.perf_counter() - start
+
+    result = world.result()
+    result.update({'start_level': level, 'seed': seed, 'seconds': round(seconds, 3),
+                   'steps_per_second': round(frames / seconds, 1) if seconds else None})
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Play many headless worlds in parallel with scripted input')
+    parser.add_argument('--levels', type=int, nargs='+', default=[0], help='levels to start the worlds on')
+    parser.add_argument('--runs', type=int, default=8, help='worlds per level')
+    parser.add_argument('--frames', type=int, default=3600, help='simulation steps per world')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first world, the others count up from it')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the cpu count')
+    parser.add_argument('--out', help='write the per-world results to this json file')
+    args = parser.parse_args(argv)
+
+    jobs = [(level, args.seed + i, args.frames) for level in args.levels for i in range(args.runs)]
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for result in pool.map(run_world, jobs):
+            results.append(result)
+            print(f"level {result['start_level']} seed {result['seed']}: {result['levels_completed']} levels completed, "
+                  f"{result['deaths']} deaths, {result['enemies_left']} enemies left, {result['steps_per_second']} steps/s")
+    seconds = time.perf_counter() - start
+
+    print(f'{len(jobs)} worlds, {len(jobs) * args.frames} steps in {seconds:.1f}s '
+          f'({len(jobs) * args.frames / seconds:.0f} steps/s)')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,7 @@
 import random
 
+import pygame
+
 
 class Cloud:
     def __init__(self, pos, img, speed, depth):
@@ -8,33 +10,88 @@ class Cloud:
         self.speed = speed
         self.depth = depth
 
+
+class CloudBand:
+    """ Clouds of about the same depth composited into one layer that wraps around like the view does
+
+    The band moves and scrolls as a whole, so drawing it is the same handful of blits however many
+    clouds it holds. The layer is only composited again when the view changes size.
+    """
+
+    def __init__(self, clouds):
+        self.clouds = clouds
+        self.depth = sum(cloud.depth for cloud in clouds) / len(clouds)
+        self.speed = sum(cloud.speed for cloud in clouds) / len(clouds)
+        self.x = 0
+        self.layer = None
+        self.margin = (0, 0)
+
+    def composite(self, view_size):
+        # a cloud has left the view completely before it comes back in on the other side
+        self.margin = (max(cloud.img.get_width() for cloud in self.clouds), max(cloud.img.get_height() for cloud in self.clouds))
+        width, height = view_size[0] + self.margin[0], view_size[1] + self.margin[1]
+        self.layer = pygame.Surface((width, height))
+        for cloud in self.clouds:
+            x, y = cloud.pos[0] % width, cloud.pos[1] % height
+            # clouds over the edge of the layer continue on the opposite edge
+            for dx in (0, -width):
+                for dy in (0, -height):
+                    self.layer.blit(cloud.img, (x + dx, y + dy))
+        # the sky between the clouds is the colorkey, run-length encoding makes skipping it nearly free
+        self.layer.set_colorkey((0, 0, 0), pygame.RLEACCEL)
+
     def update(self):
-        self.pos[0] += self.speed
+        self.x += self.speed
 
     def render(self, surf, offset=(0, 0)):
-        rendered_pos = (self.pos[0] - offset[0] * self.depth, self.pos[1] - offset[1] * self.depth)
-        render_x = rendered_pos[0] % (surf.get_width() + self.img.get_width()) - self.img.get_width()
-        render_y = rendered_pos[1] % (surf.get_height() + self.img.get_height()) - self.img.get_height()
-        surf.blit(self.img, (render_x, render_y))
+        width, height = self.layer.get_size()
+        x = (self.x - offset[0] * self.depth) % width - self.margin[0]
+        y = -offset[1] * self.depth % height - self.margin[1]
+        surf.blits([(self.layer, (x + dx, y + dy)) for dx in (0, -width) for dy in (0, -height)], doreturn=False)
 
 
 class Clouds:
-    def __init__(self, cloud_images, count=16):
-        self.clouds = []
+    """ density is clouds per 100x100 pixels of view, when it is set the count follows the view size """
+
+    def __init__(self, cloud_images, count=16, bands=3, density=None):
+        self.cloud_images = cloud_images
+        self.count = count
+        self.band_count = bands
+        self.density = density
+        self.view_size = None
+        self.bands = []
+
+    def build(self, view_size):
+        count = self.count
+        if self.density is not None:
+            count = max(1, round(view_size[0] * view_size[1] / 10000 * self.density))
 
+        clouds = []
         for i in range(count):
             pos = (random.random() * 99999, random.random() * 99999)
-            img = random.choice(cloud_images)
+            img = random.choice(self.cloud_images)
             speed = random.random() * 0.05 + 0.05
             depth = random.random() * 0.6 + 0.2
-            self.clouds.append(Cloud(pos, img, speed, depth))
+            clouds.append(Cloud(pos, img, speed, depth))
+        clouds.sort(key=lambda x: x.depth)
 
-        self.clouds.sort(key=lambda x: x.depth)
+        # bands keep the far to near drawing order of the clouds
+        band_count = min(self.band_count, count)
+        self.bands = [CloudBand(clouds[i * count // band_count:(i + 1) * count // band_count]) for i in range(band_count)]
+
+    def resize(self, view_size):
+        if self.density is not None or not self.bands:
+            self.build(view_size)
+        for band in self.bands:
+            band.composite(view_size)
+        self.view_size = view_size
 
     def update(self):
-        for cloud in self.clouds:
-            cloud.update()
+        for band in self.bands:
+            band.update()
 
     def render(self, surf, offset=(0, 0)):
-        for cloud in self.clouds:
-            cloud.render(surf, offset=offset)
\ No newline at end of file
+        if surf.get_size() != self.view_size:
+            self.resize(surf.get_size())
+        for band in self.bands:
+            band.render(surf, offset=offset)
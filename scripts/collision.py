@@ -0,0 +1,89 @@
+import pygame
+
+from scripts.grid import CHUNK_AREA, CHUNK_MASK, CHUNK_SHIFT, CHUNK_SIZE, SOLID
+
+
+def merge_solid_cells(flags):
+    """ Greedy rectangles (x, y, w, h) in cells covering the solid cells of one chunk """
+    rects = []
+    open_rects = {}
+    for y in range(CHUNK_SIZE):
+        row_open = {}
+        row = y * CHUNK_SIZE
+        x = 0
+        while x < CHUNK_SIZE:
+            if not flags[row + x] & SOLID:
+                x += 1
+                continue
+            start = x
+            while x < CHUNK_SIZE and flags[row + x] & SOLID:
+                x += 1
+            run = (start, x - start)
+            rect = open_rects.pop(run, None)
+            # a run with the same span as one in the row above extends that rect down
+            if rect is None:
+                rect = [start, y, x - start, 0]
+            rect[3] += 1
+            row_open[run] = rect
+        rects.extend(open_rects.values())
+        open_rects = row_open
+    rects.extend(open_rects.values())
+    return rects
+
+
+class CollisionLayer:
+    def __init__(self, grid, tile_size=16):
+        self.grid = grid
+        self.tile_size = tile_size
+        # chunk loc -> (chunk version, merged rects, the merged rect of every cell or None)
+        self.chunk_rects = {}
+
+    def rebuild(self, tile_size=None):
+        if tile_size is not None:
+            self.tile_size = tile_size
+        self.chunk_rects = {}
+        for chunk_loc in self.grid.chunks:
+            self.rects_in_chunk(chunk_loc)
+
+    def chunk_entry(self, chunk_loc):
+        chunk = self.grid.chunk(chunk_loc)
+        if chunk is None:
+            self.chunk_rects.pop(chunk_loc, None)
+            return None
+        cached = self.chunk_rects.get(chunk_loc)
+        if cached is not None and cached[0] == chunk.version:
+            return cached
+
+        size = self.tile_size
+        base_x, base_y = chunk_loc[0] << CHUNK_SHIFT, chunk_loc[1] << CHUNK_SHIFT
+        rects = []
+        cell_rects = [None] * CHUNK_AREA
+        for x, y, w, h in merge_solid_cells(chunk.flags):
+            rect = pygame.Rect((base_x + x) * size, (base_y + y) * size, w * size, h * size)
+            rects.append(rect)
+            for row in range(y, y + h):
+                cell_rects[row * CHUNK_SIZE + x:row * CHUNK_SIZE + x + w] = [rect] * w
+        cached = self.chunk_rects[chunk_loc] = (chunk.version, rects, cell_rects)
+        return cached
+
+    def rects_in_chunk(self, chunk_loc):
+        entry = self.chunk_entry(chunk_loc)
+        return entry[1] if entry is not None else ()
+
+    def rects_around(self, tile_x, tile_y):
+        """ The merged rects covering the 3x3 tiles around a tile, each once """
+        rects = []
+        entries = {}
+        for y in range(tile_y - 1, tile_y + 2):
+            for x in range(tile_x - 1, tile_x + 2):
+                chunk_loc = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+                entry = entries.get(chunk_loc, False)
+                if entry is False:
+                    entry = entries[chunk_loc] = self.chunk_entry(chunk_loc)
+                if entry is None:
+                    continue
+                rect = entry[2][((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)]
+                # a merged rect usually covers several of the nine tiles
+                if rect is not None and rect not in rects:
+                    rects.append(rect)
+        return rects
@@ -0,0 +1,133 @@
+import random
+
+import numpy as np
+
+POLICIES = ('drop_oldest', 'throttle', 'skip_offscreen')
+
+
+class EffectPool:
+    """ Fixed-size storage for short-lived effects with global and per-emitter caps
+
+    Subclasses keep their own arrays of `capacity` rows and list them in columns(). What happens once
+    a cap is hit depends on the policy:
+        drop_oldest    - the new effect takes the slot of the oldest one (of the same emitter for emitter caps)
+        throttle       - past soft_limit of the capacity fewer and fewer spawns get through, none when full
+        skip_offscreen - past soft_limit spawns outside of `view` are skipped, none get through when full
+    """
+
+    def __init__(self, capacity, policy='drop_oldest', emitter_caps=None, soft_limit=0.75, rng=None):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown pool policy {policy!r}, expected one of {POLICIES}')
+        self.capacity = capacity
+        self.policy = policy
+        self.emitter_caps = dict(emitter_caps or {})
+        self.soft_limit = soft_limit
+        self.rng = rng if rng is not None else random.Random()
+        # the camera rect in world coordinates, set every frame by the game
+        self.view = None
+
+        self.emitter_ids = {}
+        self.emitter_names = []
+        self.emitter_counts = []
+        self.emitter = np.zeros(capacity, dtype=np.int32)
+        self.serial = np.zeros(capacity, dtype=np.int64)
+        self.next_serial = 0
+        self.count = 0
+
+        self.spawned = 0
+        self.dropped = 0
+        self.peak = 0
+        self.dropped_by_emitter = {}
+
+    def columns(self):
+        return self.emitter, self.serial
+
+    def emitter_id(self, emitter):
+        emitter_id = self.emitter_ids.get(emitter)
+        if emitter_id is None:
+            emitter_id = self.emitter_ids[emitter] = len(self.emitter_names)
+            self.emitter_names.append(emitter)
+            self.emitter_counts.append(0)
+        return emitter_id
+
+    def oldest(self, emitter_id=None):
+        serial = self.serial[:self.count]
+        if emitter_id is not None:
+            serial = np.where(self.emitter[:self.count] == emitter_id, serial, np.iinfo(np.int64).max)
+        return int(np.argmin(serial))
+
+    def drop(self, emitter):
+        self.dropped += 1
+        self.dropped_by_emitter[emitter] = self.dropped_by_emitter.get(emitter, 0) + 1
+
+    def reserve(self, emitter='default', pos=None):
+        """ Returns the slot index for a new effect, or None when the policy drops it """
+        emitter_id = self.emitter_id(emitter)
+        cap = self.emitter_caps.get(emitter)
+        slot = None
+        if cap is not None and self.emitter_counts[emitter_id] >= cap:
+            if self.policy != 'drop_oldest':
+                return self.drop(emitter)
+            slot = self.oldest(emitter_id)
+        elif self.count >= self.capacity:
+            if self.policy != 'drop_oldest':
+                return self.drop(emitter)
+            slot = self.oldest()
+        elif self.count >= self.capacity * self.soft_limit:
+            if self.policy == 'throttle':
+                # the chance to spawn falls from 1 at the soft limit to 0 at full capacity
+                if self.rng.random() * self.capacity * (1 - self.soft_limit) > self.capacity - self.count:
+                    return self.drop(emitter)
+            elif self.policy == 'skip_offscreen':
+                if pos is not None and self.view is not None and not self.view.collidepoint(pos):
+                    return self.drop(emitter)
+
+        if slot is None:
+            slot = self.count
+            self.count += 1
+            self.peak = max(self.peak, self.count)
+        else:
+            replaced = self.emitter[slot]
+            self.emitter_counts[replaced] -= 1
+            self.drop(self.emitter_names[replaced])
+
+        self.emitter[slot] = emitter_id
+        self.serial[slot] = self.next_serial
+        self.next_serial += 1
+        self.emitter_counts[emitter_id] += 1
+        self.spawned += 1
+        return slot
+
+    def remove(self, dead):
+        """ Swap-removes the effects at the sorted slot indices in dead """
+        if not len(dead):
+            return
+        n = self.count
+        m = n - len(dead)
+        for emitter_id, count in enumerate(np.bincount(self.emitter[dead], minlength=len(self.emitter_names)).tolist()):
+            self.emitter_counts[emitter_id] -= count
+
+        # the live effects at the end of the pool fill the holes the dead ones leave before m
+        holes = dead[dead < m]
+        tail_alive = np.ones(n - m, dtype=bool)
+        tail_alive[dead[dead >= m] - m] = False
+        sources = np.flatnonzero(tail_alive) + m
+        for array in self.columns():
+            array[holes] = array[sources]
+        self.count = m
+
+    def clear(self):
+        self.count = 0
+        self.emitter_counts = [0] * len(self.emitter_names)
+
+    def stats(self):
+        return {'count': self.count,
+                'capacity': self.capacity,
+                'occupancy': self.count / self.capacity,
+                'peak': self.peak,
+                'spawned': self.spawned,
+                'dropped': self.dropped,
+                'dropped_by_emitter': dict(self.dropped_by_emitter)}
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,92 @@
+import numpy as np
+import pygame
+
+# (forward, down) probe offsets from an enemy's position: three tiles of ground ahead and the tile above the wall
+GROUND_PROBES = (23, 46, 69)
+JUMP_PROBE = -23
+PROBE_FORWARD = 7
+WALK_SPEED = 0.5
+JUMP_VELOCITY = -2
+# how far along x and y from the player an enemy will shoot at it
+SHOOT_RANGE = (180, 16)
+
+
+class EnemyController:
+    """ Decides what every enemy does this frame in one pass of array operations
+
+    The state the decisions need is gathered from the enemies into arrays, all the probes are looked up
+    in the tile grid at once, and walking, turning, jumping and shooting are written back to the enemies.
+    """
+
+    def __init__(self, game, rng=None):
+        self.game = game
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def probes(self, tilemap, pos, size, flip):
+        """ (ground ahead, tile above the wall ahead) for every enemy """
+        # the same rounding pygame.Rect does, probes start at the rect's centre
+        centerx = np.trunc(pos[:, 0]) + size[:, 0] // 2
+        x = centerx + np.where(flip, -PROBE_FORWARD, PROBE_FORWARD)
+        offsets = np.array(GROUND_PROBES + (JUMP_PROBE,), dtype=np.float64)
+        tile_x = np.floor(np.repeat(x[:, None], len(offsets), axis=1) / tilemap.tile_size).astype(np.int64)
+        tile_y = np.floor((pos[:, 1, None] + offsets) / tilemap.tile_size).astype(np.int64)
+        solid = tilemap.grid.solid_cells(tile_x.reshape(-1), tile_y.reshape(-1)).reshape(len(pos), len(offsets))
+        return solid[:, :len(GROUND_PROBES)].any(axis=1), solid[:, len(GROUND_PROBES)]
+
+    def update(self, enemies, tilemap):
+        """ Returns the movement of every enemy for its physics update """
+        n = len(enemies)
+        if not n:
+            return []
+        pos = np.array([enemy.pos for enemy in enemies], dtype=np.float64)
+        size = np.array([enemy.size for enemy in enemies], dtype=np.int64)
+        flip = np.array([enemy.flip for enemy in enemies], dtype=bool)
+        walking = np.array([enemy.walking for enemy in enemies], dtype=np.int64)
+        velocity_y = np.array([enemy.velocity[1] for enemy in enemies], dtype=np.float64)
+        blocked = np.array([enemy.collisions['right'] or enemy.collisions['left'] for enemy in enemies], dtype=bool)
+
+        ground, wall_too_high = self.probes(tilemap, pos, size, flip)
+
+        is_walking = walking > 0
+        walk_on = is_walking & ground
+        # a wall that can't be jumped and the edge of a drop both turn an enemy around
+        turn = (walk_on & blocked & wall_too_high) | (is_walking & ~ground & (velocity_y == 0))
+        jump = walk_on & blocked & ~wall_too_high
+        move = walk_on & ~blocked
+        movement_x = np.where(move, np.where(flip, -WALK_SPEED, WALK_SPEED), 0.0)
+        flip ^= turn
+
+        # at the end of walking an enemy shoots if it can, idle ones sometimes start walking or shoot
+        rolls = self.rng.random((n, 2))
+        new_walking = np.maximum(walking - 1, 0)
+        start_walking = ~is_walking & (rolls[:, 0] < 0.01)
+        new_walking[start_walking] = self.rng.integers(30, 121, size=int(start_walking.sum()))
+        shoot = (is_walking & (new_walking == 0)) | (~is_walking & ~start_walking & (rolls[:, 1] < 0.01))
+
+        for i in np.flatnonzero(turn | jump | (walking != new_walking)).tolist():
+            enemy = enemies[i]
+            enemy.flip = bool(flip[i])
+            enemy.walking = int(new_walking[i])
+            if jump[i]:
+                enemy.velocity[1] = JUMP_VELOCITY
+
+        if shoot.any():
+            self.shoot(enemies, np.flatnonzero(shoot), pos, flip)
+
+        return [(x, 0) for x in movement_x.tolist()]
+
+    def shoot(self, enemies, shooters, pos, flip):
+        """ Shooters fire if the player is roughly level with them and in front """
+        player_pos = self.game.player.pos
+        # only enemies in the band the player can be shot from are worth the exact test
+        band = pygame.Rect(player_pos[0] - SHOOT_RANGE[0], player_pos[1] - SHOOT_RANGE[1], SHOOT_RANGE[0] * 2, SHOOT_RANGE[1] * 2)
+        in_band = {id(enemy) for enemy in self.game.broadphase.query(band, 'enemy')}
+        shooters = np.array([i for i in shooters.tolist() if id(enemies[i]) in in_band], dtype=np.int64)
+        if not len(shooters):
+            return
+        dx = player_pos[0] - pos[shooters, 0]
+        dy = player_pos[1] - pos[shooters, 1]
+        facing = np.where(flip[shooters], dx < 0, dx > 0)
+        in_range = (np.abs(dy) < SHOOT_RANGE[1]) & (np.abs(dx) < SHOOT_RANGE[0]) & facing
+        for i in shooters[in_range].tolist():
+            enemies[i].shoot()
@@ -1,10 +1,8 @@
 import math
-import random
 
 import pygame
 
-from scripts.particle import Particle
-from scripts.spark import Spark
+from scripts.utils import AnimationCursor
 
 
 class PhysicsEntity:
@@ -12,6 +10,8 @@ class PhysicsEntity:
         self.game = game
         self.type = e_type
         self.pos = list(pos)
+        # where the entity was before its last update, rendering interpolates between the two
+        self.last_pos = list(pos)
         self.size = size
         self.velocity = [0, 0]
         self.collisions = {'up': False, 'down': False, 'left': False, 'right': False}
@@ -19,6 +19,7 @@ class PhysicsEntity:
         self.action = ''
         self.anim_offset = (-3, -3)
         self.flip = False
+        self.animation = AnimationCursor()
         self.set_action('idle')
 
         self.last_movement = [0, 0]
@@ -29,10 +30,11 @@ class PhysicsEntity:
     def set_action(self, action):
         if action != self.action:
             self.action = action
-            self.animation = self.game.assets[self.type + '/' + self.action].copy()
+            self.animation.start(self.game.assets[self.type + '/' + self.action])
 
     def update(self, tilemap, movement=(0, 0)):
         self.collisions = {'up': False, 'down': False, 'left': False, 'right': False}
+        self.last_pos[0], self.last_pos[1] = self.pos
 
         frame_movement = (movement[0] + self.velocity[0], movement[1] + self.velocity[1])
 
@@ -74,14 +76,24 @@ class PhysicsEntity:
 
         self.animation.update()
 
-    def render(self, surf, offset=(0, 0)):
+    def lerp_offset(self, offset, alpha):
+        """ Shifts offset so that drawing at pos lands alpha of the way from last_pos to pos """
+        return (offset[0] + (self.pos[0] - self.last_pos[0]) * (1 - alpha),
+                offset[1] + (self.pos[1] - self.last_pos[1]) * (1 - alpha))
+
+    def render(self, surf, offset=(0, 0), alpha=1.0, outline=None):
+        offset = self.lerp_offset(offset, alpha)
         render_pos = (self.pos[0] - offset[0] + self.anim_offset[0], self.pos[1] - offset[1] + self.anim_offset[1])
-        surf.blit(pygame.transform.flip(self.animation.img(), self.flip, False), render_pos)
+        img = self.animation.img(self.flip)
+        surf.blit(img, render_pos)
+        if outline is not None:
+            outline.add(img, render_pos)
 
 
 class Player(PhysicsEntity):
     def __init__(self, game, pos, size):
         super().__init__(game, 'player', pos, size)
+        self.rng = game.rng['player']
         self.air_time = 0
         self.max_jumps = 1
         self.jumps = self.max_jumps
@@ -122,11 +134,11 @@ class Player(PhysicsEntity):
 
         if abs(self.dashing) in {60, 50}:
             for i in range(20):
-                angle = random.random() * math.pi * 2
-                speed = random.random() * 0.5 + 0.5
+                angle = self.rng.random() * math.pi * 2
+                speed = self.rng.random() * 0.5 + 0.5
                 pvelocity = [math.cos(angle) * speed, math.sin(angle) * speed]
-                frame = random.randint(0, 7)
-                self.game.particles.append(Particle(self.game, 'particle', self.rect().center, pvelocity, frame))
+                frame = self.rng.randint(0, 7)
+                self.game.particles.spawn('particle', self.rect().center, pvelocity, frame, emitter='dash')
 
         if self.dashing > 0:
             self.dashing = max(0, self.dashing - 1)
@@ -136,9 +148,9 @@ class Player(PhysicsEntity):
             self.velocity[0] = abs(self.dashing) / self.dashing * 8
             if abs(self.dashing) == 51:
                 self.velocity[0] *= 0.3
-            pvelocity = [abs(self.dashing) / self.dashing * random.random() * 3, 0]
-            frame = random.randint(0, 7)
-            self.game.particles.append(Particle(self.game, 'particle', self.rect().center, pvelocity, frame))
+            pvelocity = [abs(self.dashing) / self.dashing * self.rng.random() * 3, 0]
+            frame = self.rng.randint(0, 7)
+            self.game.particles.spawn('particle', self.rect().center, pvelocity, frame, emitter='dash')
 
         if self.velocity[0] > 0:
             self.velocity[0] = max(self.velocity[0] - 0.1, 0)
@@ -150,12 +162,12 @@ class Player(PhysicsEntity):
             self.game.dead += 1
             self.dying()
             self.game.screenshake = max(self.game.shake_value * 2, self.game.screenshake)
-            self.game.sfx['fall_1'].play()
-            self.game.sfx['fall_2'].play()
+            self.game.play_sound('fall_1')
+            self.game.play_sound('fall_2')
 
-    def render(self, surf, offset=(0, 0)):
+    def render(self, surf, offset=(0, 0), alpha=1.0, outline=None):
         if abs(self.dashing) <= 50:
-            super().render(surf, offset)
+            super().render(surf, offset, alpha, outline)
 
     def respawn(self):
         #self.pos = list(self.game.spawn_points[self.game.current_spawn_point])
@@ -169,14 +181,13 @@ class Player(PhysicsEntity):
 
     def dying(self, color=(255, 255, 255)):
         for i in range(30):
-            angle = random.random() * math.pi * 2
-            speed = random.random() * 5
+            angle = self.rng.random() * math.pi * 2
+            speed = self.rng.random() * 5
             pos = self.rect().center
             velocity = [math.cos(angle + math.pi) * speed * 0.5, math.sin(angle + math.pi) * speed * 0.5]
-            frame = random.randint(0, 7)
-            particle_effect = Particle(self.game, 'particle', pos, velocity, frame)
-            self.game.particles.append(particle_effect)
-            self.game.sparks.append(Spark(pos, angle, 2 + random.random(), color))
+            frame = self.rng.randint(0, 7)
+            self.game.particles.spawn('particle', pos, velocity, frame, emitter='dying')
+            self.game.sparks.spawn(pos, angle, 2 + self.rng.random(), color, emitter='dying')
 
     def jump(self):
         if self.wall_slide:
@@ -197,7 +208,7 @@ class Player(PhysicsEntity):
 
     def dash(self):
         if not self.dashing:
-            self.game.sfx['dash'].play()
+            self.game.play_sound('dash')
             if self.flip:
                 self.dashing = -60
             else:
@@ -207,43 +218,16 @@ class Player(PhysicsEntity):
 class Enemy(PhysicsEntity):
     def __init__(self, game, pos, size):
         super().__init__(game, 'enemy', pos, size)
+        self.rng = game.rng['enemies']
 
         self.walking = 0
         self.player_collide_time = 0
 
-    def update(self, tilemap, movement=(0, 0)):
-        tiles_around = {
-            'forward_one_tile_bot': tilemap.solid_check((self.rect().centerx + (-7 if self.flip else 7), self.pos[1] + 23)),
-            'forward_two_tile_bot': tilemap.solid_check((self.rect().centerx + (-7 if self.flip else 7), self.pos[1] + 46)),
-            'forward_three_tile_bot': tilemap.solid_check((self.rect().centerx + (-7 if self.flip else 7), self.pos[1] + 69)),
-            'forward_one_tile_top': tilemap.solid_check((self.rect().centerx + (-7 if self.flip else 7), self.pos[1] - 23)),
-        }
-        if self.walking:
-            # if there's a solid tile to not drop down
-            if any([tiles_around[forward_tiles] for forward_tiles in list(tiles_around)[0:3]]):
-                # if there's solid tile in front of enemy
-                if self.collisions['right'] or self.collisions['left']:
-                    # If the enemy can't jump over
-                    if tiles_around['forward_one_tile_top']:
-                        # turning back
-                        self.flip = not self.flip
-                    else:
-                        self.velocity[1] = -2
-                else:
-                    movement = (movement[0] - 0.5 if self.flip else 0.5, movement[1])
-            # if not jumping
-            elif self.velocity[1] == 0:
-                # turning back
-                self.flip = not self.flip
-
-            self.walking = max(0, self.walking - 1)
-            if not self.walking:
-                # at the end of walking an enemy will automatically shoot if it is possibly
-                self.shoot()
-        elif random.random() < 0.01:
-            self.walking = random.randint(30, 120)
-        elif random.random() < 0.01:
-            self.shoot()
+    def update(self, tilemap, movement=(0, 0), near_player=True):
+        """ Walking, turning and shooting are decided for all enemies at once by EnemyController
+
+        near_player comes from the broadphase, enemies that aren't near skip the contact test.
+        """
         super().update(tilemap, movement=movement)
 
         if movement[0] != 0:
@@ -251,13 +235,13 @@ class Enemy(PhysicsEntity):
         else:
             self.set_action('idle')
 
-        if self.rect().colliderect(self.game.player.rect()):    # if enemy collide player
+        if near_player and self.rect().colliderect(self.game.player.rect()):    # if enemy collide player
             if abs(self.game.player.dashing) >= 50:             # if player was dashing then enemy dies
-                self.game.sfx['hit'].play()
+                self.game.play_sound('hit')
                 self.game.screenshake = max(self.game.shake_value, self.game.screenshake)
                 self.game.player.dying()
-                self.game.sparks.append(Spark(self.rect().center, 0, 5 + random.random() * 4))
-                self.game.sparks.append(Spark(self.rect().center, math.pi, 5 + random.random() * 4))
+                self.game.sparks.spawn(self.rect().center, 0, 5 + self.rng.random() * 4, emitter='hit')
+                self.game.sparks.spawn(self.rect().center, math.pi, 5 + self.rng.random() * 4, emitter='hit')
                 return True
             if not self.game.dead:
                 if self.pos[0] > self.game.player.pos[0] and self.flip or self.pos[0] < self.game.player.pos[0] and not self.flip:
@@ -266,38 +250,33 @@ class Enemy(PhysicsEntity):
             self.player_collide_time = max(0, self.player_collide_time - 1)
 
         if self.player_collide_time >= 7:
-            self.game.sfx['shoot'].play()
-            self.game.sfx['hit'].play()
+            self.game.play_sound('shoot')
+            self.game.play_sound('hit')
             self.player_collide_time = 0
             self.game.dead += 1
             self.game.player.dying()
             self.game.screenshake = max(self.game.shake_value, self.game.screenshake)
 
-    def render(self, surf, offset=(0, 0)):
-        super().render(surf, offset)
+    def render(self, surf, offset=(0, 0), alpha=1.0, outline=None):
+        offset = self.lerp_offset(offset, alpha)
+        super().render(surf, offset, outline=outline)
 
+        image = self.game.assets['gun'][self.flip]
         if self.flip:
-            image = pygame.transform.flip(self.game.assets['gun'], True, False)
-            pos = (self.rect().centerx - 4 - self.game.assets['gun'].get_width() - offset[0],
-                   self.rect().centery - offset[1])
+            pos = (self.rect().centerx - 4 - image.get_width() - offset[0], self.rect().centery - offset[1])
         else:
-            image = self.game.assets['gun']
             pos = (self.rect().centerx + 4 - offset[0], self.rect().centery - offset[1])
         surf.blit(image, pos)
+        if outline is not None:
+            outline.add(image, pos)
 
     def shoot(self):
         """ Will shoot if it is possible """
         dis = (self.game.player.pos[0] - self.pos[0], self.game.player.pos[1] - self.pos[1])
         if abs(dis[1]) < 16 and abs(dis[0]) < 180:
             if self.flip and dis[0] < 0:
-                self.game.sfx['shoot'].play()
-                self.game.projectiles.append([[self.rect().centerx - 7, self.rect().centery], -1.5, 0])
-                for i in range(4):
-                    self.game.sparks.append(
-                        Spark(self.game.projectiles[-1][0], random.random() - 0.5 + math.pi, 2 + random.random()))
+                self.game.play_sound('shoot')
+                self.game.projectiles.spawn((self.rect().centerx - 7, self.rect().centery), (-1.5, 0), emitter='enemy')
             if not self.flip and dis[0] > 0:
-                self.game.sfx['shoot'].play()
-                self.game.projectiles.append([[self.rect().centerx + 7, self.rect().centery], 1.5, 0])
-                for i in range(4):
-                    self.game.sparks.append(
-                        Spark(self.game.projectiles[-1][0], random.random() - 0.5, 2 + random.random()))
\ No newline at end of file
+                self.game.play_sound('shoot')
+                self.game.projectiles.spawn((self.rect().centerx + 7, self.rect().centery), (1.5, 0), emitter='enemy')
\ No newline at end of file
@@ -0,0 +1,331 @@
+from array import array
+from collections.abc import MutableMapping
+
+import numpy as np
+
+CHUNK_SHIFT = 4
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+CHUNK_AREA = CHUNK_SIZE * CHUNK_SIZE
+
+SOLID = 1
+
+
+def parse_loc(loc):
+    x, y = loc.split(';')
+    return int(x), int(y)
+
+
+class Chunk:
+    __slots__ = ('ids', 'rotations', 'flags', 'count', 'version')
+
+    def __init__(self, ids=None, rotations=None, flags=None, count=0):
+        # id 0 is an empty cell, other ids index the grid palette
+        self.ids = ids if ids is not None else array('H', bytes(2 * CHUNK_AREA))
+        self.rotations = rotations if rotations is not None else array('H', bytes(2 * CHUNK_AREA))
+        self.flags = flags if flags is not None else bytearray(CHUNK_AREA)
+        self.count = count
+        self.version = 0
+
+
+class TileGrid:
+    def __init__(self, solid_types=()):
+        self.solid_types = set(solid_types)
+        self.chunks = {}
+        # chunks of an attached MapFile that haven't been decoded yet
+        self.pending = {}
+        self.pending_files = {}
+        self.pending_count = 0
+        # tile id -> {chunk loc: number of those tiles in the chunk}, for decoded chunks
+        self.index = {}
+        self.palette = [None]
+        self.palette_ids = {}
+        self.palette_flags = [0]
+        self.count = 0
+        # bumped on every edit, chunks remember the value of their last edit
+        self.version = 0
+
+    def tile_id(self, tile_type, variant):
+        key = (tile_type, variant)
+        tile_id = self.palette_ids.get(key)
+        if tile_id is None:
+            tile_id = len(self.palette)
+            self.palette.append(key)
+            self.palette_ids[key] = tile_id
+            self.palette_flags.append(SOLID if tile_type in self.solid_types else 0)
+        return tile_id
+
+    def clear(self):
+        for map_file in self.pending_files:
+            map_file.close()
+        self.chunks = {}
+        self.pending = {}
+        self.pending_files = {}
+        self.pending_count = 0
+        self.index = {}
+        self.count = 0
+
+    def palette_lut(self, palette):
+        """ Maps the tile ids of another palette to ids of this grid """
+        return np.array([0] + [self.tile_id(*key) for key in palette[1:]], dtype=np.uint16)
+
+    def index_add(self, tile_id, chunk_loc, count=1):
+        chunk_counts = self.index.get(tile_id)
+        if chunk_counts is None:
+            chunk_counts = self.index[tile_id] = {}
+        count += chunk_counts.get(chunk_loc, 0)
+        if count:
+            chunk_counts[chunk_loc] = count
+        else:
+            del chunk_counts[chunk_loc]
+
+    def index_chunk(self, chunk_loc, ids, sign=1):
+        tile_ids, counts = np.unique(ids, return_counts=True)
+        for tile_id, count in zip(tile_ids.tolist(), counts.tolist()):
+            if tile_id:
+                self.index_add(tile_id, chunk_loc, sign * count)
+
+    def add_chunk(self, chunk_loc, ids, rotations, lut, count):
+        """ Adds a chunk from numpy arrays whose ids index the palette the lut came from """
+        ids = lut[ids]
+        flags = np.array(self.palette_flags, dtype=np.uint8)[ids]
+        chunk = Chunk(array('H', ids.tobytes()), array('H', rotations.astype(np.uint16).tobytes()),
+                      bytearray(flags.tobytes()), count)
+        old_chunk = self.chunks.get(chunk_loc)
+        if old_chunk is not None:
+            self.count -= old_chunk.count
+            self.index_chunk(chunk_loc, old_chunk.ids, -1)
+        self.count += count
+        self.index_chunk(chunk_loc, ids)
+        self.version += 1
+        chunk.version = self.version
+        self.chunks[chunk_loc] = chunk
+        return chunk
+
+    def unload(self, chunk_loc):
+        chunk = self.chunks.pop(chunk_loc, None)
+        if chunk is not None:
+            self.count -= chunk.count
+            self.index_chunk(chunk_loc, chunk.ids, -1)
+            self.version += 1
+
+    def attach(self, map_file):
+        """ Adds the chunks of a MapFile, each one is decoded the first time it is used """
+        if not map_file.chunks:
+            map_file.close()
+            return
+        lut = self.palette_lut(map_file.palette)
+        for chunk_loc in map_file.chunks:
+            self.pending[chunk_loc] = (map_file, lut)
+        # map file -> [chunks still pending, lut]
+        self.pending_files[map_file] = [len(map_file.chunks), lut]
+        self.pending_count += sum(count for count, offset in map_file.chunks.values())
+
+    def decode(self, chunk_loc):
+        map_file, lut = self.pending.pop(chunk_loc)
+        ids, rotations = map_file.chunk_arrays(chunk_loc)
+        count = map_file.chunks[chunk_loc][0]
+        self.pending_count -= count
+        chunk = self.add_chunk(chunk_loc, ids, rotations, lut, count)
+        self.pending_files[map_file][0] -= 1
+        if not self.pending_files[map_file][0]:
+            del self.pending_files[map_file]
+            map_file.close()
+        return chunk
+
+    def decode_all(self):
+        for chunk_loc in list(self.pending):
+            self.decode(chunk_loc)
+
+    def chunk(self, chunk_loc):
+        chunk = self.chunks.get(chunk_loc)
+        if chunk is None and chunk_loc in self.pending:
+            chunk = self.decode(chunk_loc)
+        return chunk
+
+    def set(self, x, y, tile_type, variant, rotation=0):
+        tile_id = self.tile_id(tile_type, variant)
+        chunk_loc = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        chunk = self.chunk(chunk_loc)
+        if chunk is None:
+            chunk = self.chunks[chunk_loc] = Chunk()
+        i = (y & CHUNK_MASK) << CHUNK_SHIFT | (x & CHUNK_MASK)
+        rotation %= 360
+        old_id = chunk.ids[i]
+        if old_id == tile_id and chunk.rotations[i] == rotation:
+            return
+        if not old_id:
+            chunk.count += 1
+            self.count += 1
+        if old_id != tile_id:
+            if old_id:
+                self.index_add(old_id, chunk_loc, -1)
+            self.index_add(tile_id, chunk_loc)
+        chunk.ids[i] = tile_id
+        chunk.rotations[i] = rotation
+        chunk.flags[i] = self.palette_flags[tile_id]
+        self.version += 1
+        chunk.version = self.version
+
+    def write_ids(self, chunk_loc, ids):
+        """ Overwrites the tile ids of a chunk, the new ids must keep the same tile types """
+        chunk = self.chunk(chunk_loc)
+        chunk_ids = np.frombuffer(chunk.ids, dtype=np.uint16)
+        ids = np.asarray(ids, dtype=np.uint16).reshape(-1)
+        if np.array_equal(chunk_ids, ids):
+            return
+        self.index_chunk(chunk_loc, chunk_ids, -1)
+        chunk_ids[:] = ids
+        self.index_chunk(chunk_loc, chunk_ids)
+        self.version += 1
+        chunk.version = self.version
+
+    def find(self, tile_ids):
+        """ Returns (x, y, tile_id, rotation) of every tile with one of the ids """
+        tile_ids = [tile_id for tile_id in tile_ids if tile_id]
+        if not tile_ids:
+            return []
+        # chunks that are still in their map file only get decoded if they hold a match
+        for map_file, (remaining, lut) in list(self.pending_files.items()):
+            if map_file.chunks_with is None:
+                # files without a palette index have every pending chunk searched
+                candidates = [chunk_loc for chunk_loc, (chunk_file, chunk_lut) in self.pending.items() if chunk_file is map_file
+                              and np.isin(lut[map_file.chunk_arrays(chunk_loc)[0]], tile_ids).any()]
+            else:
+                candidates = [chunk_loc for file_id in np.flatnonzero(np.isin(lut, tile_ids)).tolist()
+                              for chunk_loc in map_file.chunks_with[file_id]]
+            for chunk_loc in candidates:
+                pending = self.pending.get(chunk_loc)
+                if pending is not None and pending[0] is map_file:
+                    self.decode(chunk_loc)
+
+        found = []
+        for tile_id in tile_ids:
+            for chunk_loc in self.index.get(tile_id, ()):
+                chunk = self.chunks[chunk_loc]
+                base_x, base_y = chunk_loc[0] << CHUNK_SHIFT, chunk_loc[1] << CHUNK_SHIFT
+                for i in np.flatnonzero(np.frombuffer(chunk.ids, dtype=np.uint16) == tile_id).tolist():
+                    found.append((base_x + (i & CHUNK_MASK), base_y + (i >> CHUNK_SHIFT), tile_id, chunk.rotations[i]))
+        return found
+
+    def remove(self, x, y):
+        chunk_loc = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        chunk = self.chunk(chunk_loc)
+        if chunk is None:
+            return False
+        i = (y & CHUNK_MASK) << CHUNK_SHIFT | (x & CHUNK_MASK)
+        old_id = chunk.ids[i]
+        if not old_id:
+            return False
+        self.index_add(old_id, chunk_loc, -1)
+        chunk.ids[i] = 0
+        chunk.rotations[i] = 0
+        chunk.flags[i] = 0
+        chunk.count -= 1
+        self.count -= 1
+        self.version += 1
+        chunk.version = self.version
+        if not chunk.count:
+            del self.chunks[chunk_loc]
+        return True
+
+    def get(self, x, y):
+        chunk_loc = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        chunk = self.chunks.get(chunk_loc)
+        if chunk is None:
+            if chunk_loc not in self.pending:
+                return 0
+            chunk = self.decode(chunk_loc)
+        return chunk.ids[(y & CHUNK_MASK) << CHUNK_SHIFT | (x & CHUNK_MASK)]
+
+    def is_solid(self, x, y):
+        chunk_loc = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        chunk = self.chunks.get(chunk_loc)
+        if chunk is None:
+            if chunk_loc not in self.pending:
+                return False
+            chunk = self.decode(chunk_loc)
+        return chunk.flags[(y & CHUNK_MASK) << CHUNK_SHIFT | (x & CHUNK_MASK)] & SOLID != 0
+
+    def solid_cells(self, xs, ys):
+        """ is_solid for integer arrays of tile coordinates, one lookup per chunk touched """
+        solid = np.zeros(len(xs), dtype=bool)
+        if not len(xs):
+            return solid
+        cells = (ys & CHUNK_MASK) << CHUNK_SHIFT | (xs & CHUNK_MASK)
+        chunk_locs, inverse = np.unique(np.stack([xs >> CHUNK_SHIFT, ys >> CHUNK_SHIFT], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for i, chunk_loc in enumerate(chunk_locs.tolist()):
+            chunk = self.chunk(tuple(chunk_loc))
+            if chunk is None:
+                continue
+            selected = inverse == i
+            solid[selected] = np.frombuffer(chunk.flags, dtype=np.uint8)[cells[selected]] & SOLID != 0
+        return solid
+
+    def tile(self, x, y):
+        """ Returns (type, variant, rotation) or None for an empty cell """
+        chunk_loc = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        chunk = self.chunks.get(chunk_loc)
+        if chunk is None:
+            if chunk_loc not in self.pending:
+                return None
+            chunk = self.decode(chunk_loc)
+        i = (y & CHUNK_MASK) << CHUNK_SHIFT | (x & CHUNK_MASK)
+        tile_id = chunk.ids[i]
+        if not tile_id:
+            return None
+        tile_type, variant = self.palette[tile_id]
+        return tile_type, variant, chunk.rotations[i]
+
+    def chunk_tiles(self, chunk_loc):
+        chunk = self.chunk(chunk_loc)
+        if chunk is None:
+            return
+        base_x, base_y = chunk_loc[0] << CHUNK_SHIFT, chunk_loc[1] << CHUNK_SHIFT
+        ids = chunk.ids
+        for i in range(CHUNK_AREA):
+            if ids[i]:
+                yield base_x + (i & CHUNK_MASK), base_y + (i >> CHUNK_SHIFT), ids[i], chunk.rotations[i]
+
+    def __iter__(self):
+        """ Yields (x, y, tile_id, rotation) for every placed tile """
+        for chunk_loc in list(self.chunks) + list(self.pending):
+            yield from self.chunk_tiles(chunk_loc)
+
+    def __len__(self):
+        return self.count + self.pending_count
+
+
+class GridView(MutableMapping):
+    """ The old {"x;y": tile} interface on top of a TileGrid """
+
+    def __init__(self, grid):
+        self.grid = grid
+
+    def __getitem__(self, loc):
+        x, y = parse_loc(loc)
+        tile = self.grid.tile(x, y)
+        if tile is None:
+            raise KeyError(loc)
+        return {'type': tile[0], 'variant': tile[1], 'pos': [x, y], 'rotation': tile[2]}
+
+    def __setitem__(self, loc, tile):
+        x, y = parse_loc(loc)
+        self.grid.set(x, y, tile['type'], tile['variant'], tile.get('rotation', 0))
+
+    def __delitem__(self, loc):
+        x, y = parse_loc(loc)
+        if not self.grid.remove(x, y):
+            raise KeyError(loc)
+
+    def __contains__(self, loc):
+        x, y = parse_loc(loc)
+        return self.grid.get(x, y) != 0
+
+    def __iter__(self):
+        for x, y, tile_id, rotation in self.grid:
+            yield f"{x};{y}"
+
+    def __len__(self):
+        return len(self.grid)
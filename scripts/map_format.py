@@ -0,0 +1,222 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+from scripts.grid import CHUNK_AREA, CHUNK_SHIFT, CHUNK_SIZE, CHUNK_MASK
+
+# magic, version, tile size, chunk size, palette size, chunks, offgrid tiles, hover tiles, meta json length
+HEADER = struct.Struct('<4sHHHHIIII')
+PALETTE_ENTRY = struct.Struct('<BH')
+CHUNK_ENTRY = struct.Struct('<iiHI')
+OFFGRID_ENTRY = struct.Struct('<HddH')
+CHUNK_BYTES = CHUNK_AREA * 4
+# version 2 follows the meta json with the chunks of every palette entry: a count, then directory indexes
+INDEX_COUNT = struct.Struct('<I')
+
+MAGIC = b'NJMP'
+VERSION = 2
+MAP_KEYS = ('tilemap', 'tile_size', 'offgrid', 'offgrid_hover_tiles')
+
+
+class MapFile:
+    """ Memory-mapped binary map, chunks are only decoded when asked for """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.tile_size, chunk_size, palette_count,
+         chunk_count, offgrid_count, hover_count, meta_len) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a binary map')
+        if version > VERSION:
+            raise ValueError(f'{path} has map format version {version}, newest supported is {VERSION}')
+        if chunk_size != CHUNK_SIZE:
+            raise ValueError(f'{path} uses {chunk_size}x{chunk_size} chunks, expected {CHUNK_SIZE}x{CHUNK_SIZE}')
+
+        pos = HEADER.size
+        self.palette = [None]
+        for i in range(palette_count):
+            name_len, variant = PALETTE_ENTRY.unpack_from(self.data, pos)
+            pos += PALETTE_ENTRY.size
+            self.palette.append((self.data[pos:pos + name_len].decode(), variant))
+            pos += name_len
+
+        # chunk loc -> (tile count, offset of the chunk data)
+        self.chunks = {}
+        chunk_locs = []
+        for i in range(chunk_count):
+            chunk_x, chunk_y, count, offset = CHUNK_ENTRY.unpack_from(self.data, pos)
+            self.chunks[(chunk_x, chunk_y)] = (count, offset)
+            chunk_locs.append((chunk_x, chunk_y))
+            pos += CHUNK_ENTRY.size
+
+        self.offgrid_tiles, pos = self.read_offgrid(pos, offgrid_count)
+        self.offgrid_hover_tiles, pos = self.read_offgrid(pos, hover_count)
+        self.meta = json.loads(self.data[pos:pos + meta_len].decode()) if meta_len else {}
+        pos += meta_len
+
+        # palette id -> locs of the chunks holding it, None for version 1 files that have no index
+        self.chunks_with = None
+        if version >= 2:
+            self.chunks_with = {}
+            for tile_id in range(1, palette_count + 1):
+                count, = INDEX_COUNT.unpack_from(self.data, pos)
+                pos += INDEX_COUNT.size
+                indexes = np.frombuffer(self.data, dtype='<u4', count=count, offset=pos).tolist() if count else []
+                self.chunks_with[tile_id] = [chunk_locs[i] for i in indexes]
+                pos += count * 4
+
+    def read_offgrid(self, pos, count):
+        tiles = []
+        for i in range(count):
+            tile_id, x, y, rotation = OFFGRID_ENTRY.unpack_from(self.data, pos)
+            tile_type, variant = self.palette[tile_id]
+            tiles.append({'type': tile_type, 'variant': variant, 'pos': [x, y], 'rotation': rotation})
+            pos += OFFGRID_ENTRY.size
+        return tiles, pos
+
+    def chunk_arrays(self, chunk_loc):
+        """ Returns the (ids, rotations) numpy arrays of a chunk, ids index this file's palette """
+        count, offset = self.chunks[chunk_loc]
+        # slicing copies the chunk out so no views into the mmap outlive close()
+        chunk_data = np.frombuffer(self.data[offset:offset + CHUNK_BYTES], dtype='<u2')
+        return chunk_data[:CHUNK_AREA], chunk_data[CHUNK_AREA:]
+
+    def tiles(self):
+        for chunk_loc in self.chunks:
+            ids, rotations = self.chunk_arrays(chunk_loc)
+            base_x, base_y = chunk_loc[0] << CHUNK_SHIFT, chunk_loc[1] << CHUNK_SHIFT
+            for i in np.flatnonzero(ids):
+                tile_type, variant = self.palette[ids[i]]
+                pos = [base_x + int(i & CHUNK_MASK), base_y + int(i >> CHUNK_SHIFT)]
+                yield {'type': tile_type, 'variant': variant, 'pos': pos, 'rotation': int(rotations[i])}
+
+    def to_map_data(self):
+        map_data = {'tilemap': {f"{tile['pos'][0]};{tile['pos'][1]}": tile for tile in self.tiles()},
+                    'tile_size': self.tile_size,
+                    'offgrid': self.offgrid_tiles,
+                    'offgrid_hover_tiles': self.offgrid_hover_tiles}
+        map_data.update(self.meta)
+        return map_data
+
+    def close(self):
+        self.data.close()
+
+
+def read_map(path):
+    map_file = MapFile(path)
+    try:
+        return map_file.to_map_data()
+    finally:
+        map_file.close()
+
+
+def write_map(path, map_data):
+    """ Writes map data in the json layout to a binary map """
+    palette_ids = {}
+    palette = []
+
+    def tile_id(tile):
+        key = (tile['type'], tile['variant'])
+        if key not in palette_ids:
+            palette.append(key)
+            palette_ids[key] = len(palette)
+        return palette_ids[key]
+
+    chunks = {}
+    for tile in map_data['tilemap'].values():
+        x, y = tile['pos']
+        chunk_loc = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        if chunk_loc not in chunks:
+            chunks[chunk_loc] = (np.zeros(CHUNK_AREA, dtype='<u2'), np.zeros(CHUNK_AREA, dtype='<u2'))
+        ids, rotations = chunks[chunk_loc]
+        i = (y & CHUNK_MASK) << CHUNK_SHIFT | (x & CHUNK_MASK)
+        ids[i] = tile_id(tile)
+        rotations[i] = tile.get('rotation', 0) % 360
+
+    offgrid = b''.join(OFFGRID_ENTRY.pack(tile_id(tile), tile['pos'][0], tile['pos'][1], tile.get('rotation', 0) % 360)
+                       for tile in map_data['offgrid'])
+    hover = b''.join(OFFGRID_ENTRY.pack(tile_id(tile), tile['pos'][0], tile['pos'][1], tile.get('rotation', 0) % 360)
+                     for tile in map_data['offgrid_hover_tiles'])
+    meta = {key: value for key, value in map_data.items() if key not in MAP_KEYS}
+    meta = json.dumps(meta).encode() if meta else b''
+
+    chunks_with = [[] for key in palette]
+    for i, (ids, rotations) in enumerate(chunks.values()):
+        for tile_id in np.unique(ids).tolist():
+            if tile_id:
+                chunks_with[tile_id - 1].append(i)
+    index = b''.join(INDEX_COUNT.pack(len(indexes)) + np.array(indexes, dtype='<u4').tobytes() for indexes in chunks_with)
+
+    palette_data = b''.join(PALETTE_ENTRY.pack(len(name.encode()), variant) + name.encode() for name, variant in palette)
+    header = HEADER.pack(MAGIC, VERSION, map_data['tile_size'], CHUNK_SIZE, len(palette),
+                         len(chunks), len(map_data['offgrid']), len(map_data['offgrid_hover_tiles']), len(meta))
+
+    offset = (len(header) + len(palette_data) + CHUNK_ENTRY.size * len(chunks) + len(offgrid) + len(hover) + len(meta)
+              + len(index))
+    directory = []
+    for chunk_loc, (ids, rotations) in chunks.items():
+        directory.append(CHUNK_ENTRY.pack(chunk_loc[0], chunk_loc[1], int(np.count_nonzero(ids)), offset))
+        offset += CHUNK_BYTES
+
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(palette_data)
+        f.write(b''.join(directory))
+        f.write(offgrid)
+        f.write(hover)
+        f.write(meta)
+        f.write(index)
+        for ids, rotations in chunks.values():
+            f.write(ids.tobytes())
+            f.write(rotations.tobytes())
+
+
+def read_json_map(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json_map(path, map_data):
+    with open(path, 'w') as f:
+        json.dump(map_data, f)
+
+
+def same_map(a, b):
+    """ Map data equality, ignoring json list/tuple differences """
+    return json.loads(json.dumps(a)) == json.loads(json.dumps(b))
+
+
+def convert(path):
+    name, ext = os.path.splitext(path)
+    if ext == '.json':
+        map_data = read_json_map(path)
+        out_path = name + '.map'
+        write_map(out_path, map_data)
+    else:
+        map_data = read_map(path)
+        out_path = name + '.json'
+        write_json_map(out_path, map_data)
+
+    converted = read_json_map(out_path) if out_path.endswith('.json') else read_map(out_path)
+    if not same_map(map_data, converted):
+        raise ValueError(f'{path} did not round-trip through {out_path}')
+    print(f'Converted {path} to {out_path}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert maps between the json and the binary .map format')
+    parser.add_argument('paths', nargs='+', help='.json maps become .map files and .map files become .json')
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        convert(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from scripts.map_format import read_map, write_map
+
+# (version, function) pairs, a map at version n gets every migration above n applied in order
+MIGRATIONS = []
+
+
+def migration(version, binary_tiles=False):
+    """ binary_tiles marks migrations that have to see the tiles of binary maps too, not just their offgrid layers and meta """
+    def register(func):
+        func.binary_tiles = binary_tiles
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+
+# binary maps always store a rotation for their tiles
+@migration(1)
+def add_rotation(map_data):
+    for tile in map_data['tilemap'].values():
+        tile.setdefault('rotation', 0)
+    for tile in map_data['offgrid']:
+        tile.setdefault('rotation', 0)
+
+
+@migration(2)
+def add_offgrid_hover(map_data):
+    map_data.setdefault('offgrid_hover_tiles', [])
+
+
+@migration(3)
+def add_spawn_points(map_data):
+    map_data.setdefault('spawn_points', {})
+
+
+@migration(4)
+def fix_enemies_in_offgrid_hover(map_data):
+    """ Spawners belong to the offgrid layer, the game only extracts them from there """
+    hover_tiles = []
+    for tile in map_data['offgrid_hover_tiles']:
+        if tile['type'] == 'spawners':
+            map_data['offgrid'].append(tile)
+        else:
+            hover_tiles.append(tile)
+    map_data['offgrid_hover_tiles'] = hover_tiles
+
+
+MAP_VERSION = MIGRATIONS[-1][0]
+
+
+def map_version(map_data):
+    # maps from before versioning have no version key
+    return map_data.get('version', 0)
+
+
+def migrate(map_data):
+    """ Upgrades map data in place to MAP_VERSION, returns the version it started at """
+    version = map_version(map_data)
+    if version > MAP_VERSION:
+        raise ValueError(f'map version {version} is newer than the supported {MAP_VERSION}')
+    for migration_version, func in MIGRATIONS:
+        if migration_version > version:
+            func(map_data)
+    map_data['version'] = MAP_VERSION
+    return version
+
+
+def needs_tiles(version):
+    """ Whether upgrading a binary map from version has to decode all of its tiles """
+    return any(func.binary_tiles for migration_version, func in MIGRATIONS if migration_version > version)
+
+
+def write_atomic(path, map_data):
+    """ Writes to a temporary file next to path and swaps it in, so a crash never leaves half a map """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        if path.endswith('.map'):
+            write_map(tmp_path, map_data)
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(map_data, f)
+        # mkstemp makes the file owner-only, the map keeps the permissions it had
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def migrate_file(path, dry_run=False):
+    if path.endswith('.map'):
+        map_data = read_map(path)
+    else:
+        with open(path, 'r') as f:
+            map_data = json.load(f)
+
+    old_version = migrate(map_data)
+    if old_version != MAP_VERSION and not dry_run:
+        write_atomic(path, map_data)
+    return path, old_version
+
+
+def map_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(('.json', '.map')):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=f'Upgrade maps to map version {MAP_VERSION}')
+    parser.add_argument('paths', nargs='+', help='map files or directories of maps')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the cpu count')
+    parser.add_argument('--dry-run', action='store_true', help="report what would change but don't write")
+    args = parser.parse_args(argv)
+
+    paths = list(map_paths(args.paths))
+    upgraded = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for path, old_version in pool.map(migrate_file, paths, [args.dry_run] * len(paths), chunksize=16):
+            if old_version != MAP_VERSION:
+                upgraded += 1
+                print(f'{path}: version {old_version} -> {MAP_VERSION}')
+
+    print(f'{upgraded} of {len(paths)} maps {"need upgrading" if args.dry_run else "upgraded"}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
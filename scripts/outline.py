@@ -0,0 +1,85 @@
+from collections import OrderedDict
+
+import pygame
+import pygame.gfxdraw
+
+SILHOUETTE_COLOR = (0, 0, 0, 180)
+OUTLINE_OFFSETS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+
+def silhouette(img):
+    return pygame.mask.from_surface(img).to_surface(setcolor=SILHOUETTE_COLOR, unsetcolor=(0, 0, 0, 0))
+
+
+def outline(img):
+    """ The silhouette of img stamped at the four outline offsets, one pixel larger on every side """
+    sil = silhouette(img)
+    surf = pygame.Surface((img.get_width() + 2, img.get_height() + 2), pygame.SRCALPHA)
+    for dx, dy in OUTLINE_OFFSETS:
+        surf.blit(sil, (1 + dx, 1 + dy))
+    return surf
+
+
+class OutlineLayer:
+    """ Outlines and shadows of the sprites drawn on the display, queued while they render
+
+    Every animation frame and its flipped copy is its own image, so caching by image caches by
+    (frame, flip). Baked tile chunks keep their outlines next to the baked surface in the tilemap
+    and are queued with add_baked(), shapes drawn straight onto the display with add_polygon().
+    draw() puts everything queued behind the display in one batch, the outlines first and the
+    shadows over them.
+
+    Each sprite stamps its own outline, so where sprites overlap (decor over tiles, the gun over its
+    enemy) the outline comes out a little darker than an outline of everything at once would.
+    """
+
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self.outlines = OrderedDict()
+        self.silhouettes = OrderedDict()
+        # (x, y) offset of the shadows or None to draw no shadows
+        self.shadow = None
+        self.outline_blits = []
+        self.shadow_blits = []
+        self.polygons = []
+
+    def cached(self, cache, img, build):
+        surf = cache.get(img)
+        if surf is None:
+            surf = cache[img] = build(img)
+            if len(cache) > self.max_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(img)
+        return surf
+
+    def add(self, img, pos):
+        shadow = self.cached(self.silhouettes, img, silhouette) if self.shadow is not None else None
+        self.add_baked(self.cached(self.outlines, img, outline), shadow, pos)
+
+    def add_baked(self, outline_surf, silhouette_surf, pos):
+        """ Queues an outline made by outline() and, when shadows are on, a silhouette made by silhouette() """
+        self.outline_blits.append((outline_surf, (pos[0] - 1, pos[1] - 1)))
+        if self.shadow is not None:
+            self.shadow_blits.append((silhouette_surf, (pos[0] + self.shadow[0], pos[1] + self.shadow[1])))
+
+    def add_polygon(self, points):
+        """ Queues a polygon that has no image to cache, its outline and shadow are drawn as polygons too """
+        self.polygons.append(points)
+
+    def draw(self, surf):
+        surf.blits(self.outline_blits, doreturn=False)
+        for points in self.polygons:
+            for dx, dy in OUTLINE_OFFSETS:
+                pygame.gfxdraw.filled_polygon(surf, [(x + dx, y + dy) for x, y in points], SILHOUETTE_COLOR)
+        surf.blits(self.shadow_blits, doreturn=False)
+        if self.shadow is not None:
+            for points in self.polygons:
+                pygame.gfxdraw.filled_polygon(surf, [(x + self.shadow[0], y + self.shadow[1]) for x, y in points], SILHOUETTE_COLOR)
+        self.outline_blits.clear()
+        self.shadow_blits.clear()
+        self.polygons.clear()
+
+    def clear(self):
+        self.outlines.clear()
+        self.silhouettes.clear()
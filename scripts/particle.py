@@ -1,25 +1,80 @@
-class Particle:
-    def __init__(self, game, p_type, pos, velocity=(0, 0), frame=0):
-        self.game = game
-        self.type = p_type
-        self.pos = list(pos)
-        self.velocity = list(velocity)
-        self.animation = self.game.assets["particle/" + p_type].copy()
-        self.animation.frame = frame
+import numpy as np
+
+from scripts.effects import EffectPool
+
+
+class ParticleSystem(EffectPool):
+    """ All particles in flat numpy arrays, updated in one step and drawn with one blits call
+
+    Particle types are the non-looping animation clips passed in, a particle lives until its animation ends.
+    Leaves sway sideways with their animation frame.
+    """
+
+    def __init__(self, clips, capacity=2048, sway_type='leaf', policy='drop_oldest', emitter_caps=None, rng=None):
+        super().__init__(capacity, policy, emitter_caps, rng=rng)
+        self.type_names = list(clips)
+        self.type_ids = {name: i for i, name in enumerate(self.type_names)}
+        self.sway_type = self.type_ids.get(sway_type, -1)
+
+        # every image of every type in one list, a particle's image is image_base[type] + frame // duration
+        self.images = []
+        image_base, durations, last_frames = [], [], []
+        for name in self.type_names:
+            clip = clips[name]
+            image_base.append(len(self.images))
+            self.images.extend(clip.images)
+            durations.append(clip.img_duration)
+            last_frames.append(clip.length - 1)
+        self.image_base = np.array(image_base, dtype=np.int32)
+        self.durations = np.array(durations, dtype=np.int32)
+        self.last_frames = np.array(last_frames, dtype=np.int32)
+        self.half_sizes = np.array([(img.get_width() // 2, img.get_height() // 2) for img in self.images], dtype=np.float64)
+
+        self.pos, self.velocity = np.zeros((capacity, 2)), np.zeros((capacity, 2))
+        self.frame, self.kind = np.zeros(capacity, dtype=np.int32), np.zeros(capacity, dtype=np.int32)
+        self.done = np.zeros(capacity, dtype=bool)
+
+    def columns(self):
+        return super().columns() + (self.pos, self.velocity, self.frame, self.kind, self.done)
+
+    def spawn(self, p_type, pos, velocity=(0, 0), frame=0, emitter='default'):
+        """ Returns False if the pool dropped the particle """
+        i = self.reserve(emitter, pos)
+        if i is None:
+            return False
+        self.pos[i] = pos
+        self.velocity[i] = velocity
+        self.frame[i] = frame
+        self.kind[i] = self.type_ids[p_type]
+        self.done[i] = False
+        return True
 
     def update(self):
-        kill = False
-        if self.animation.done:
-            kill = True
+        n = self.count
+        if not n:
+            return
 
-        self.pos[0] += self.velocity[0]
-        self.pos[1] += self.velocity[1]
+        # particles that finished last frame go first, the last live particles are swapped into their slots
+        self.remove(np.flatnonzero(self.done[:n]))
+        n = self.count
+        if not n:
+            return
 
-        self.animation.update()
+        pos, frame, kind = self.pos[:n], self.frame[:n], self.kind[:n]
+        pos += self.velocity[:n]
+        last_frames = self.last_frames[kind]
+        np.minimum(frame + 1, last_frames, out=frame)
+        self.done[:n] = frame >= last_frames
 
-        return kill
+        sway = kind == self.sway_type
+        pos[sway, 0] += np.sin(frame[sway] * 0.035) * 0.3
 
     def render(self, surf, offset=(0, 0)):
-        img = self.animation.img()
-        pos = (self.pos[0] - offset[0] - img.get_width() // 2, self.pos[1] - offset[1] - img.get_height() // 2)
-        surf.blit(img, pos)
+        n = self.count
+        if not n:
+            return
+        kind = self.kind[:n]
+        image_ids = self.image_base[kind] + self.frame[:n] // self.durations[kind]
+        render_pos = self.pos[:n] - offset - self.half_sizes[image_ids]
+        images = self.images
+        surf.blits([(images[i], pos) for i, pos in zip(image_ids.tolist(), render_pos.tolist())], doreturn=False)
@@ -0,0 +1,132 @@
+import csv
+import json
+import time
+from collections import deque
+
+import numpy as np
+import pygame
+
+
+class FrameProfiler:
+    """ Opt-in timings of the stages of every frame
+
+    Between begin() and end() each mark(name) books the time since the previous mark to the stage
+    `name`, a stage marked several times in a frame (like the steps of the simulation) adds up.
+    While disabled mark() returns right away, so the marks can stay in the code.
+
+    The last `window` frames feed the p50/p99 overlay, the last `max_frames` are kept for exporting
+    as csv or as a Chrome trace (chrome://tracing or ui.perfetto.dev).
+    """
+
+    def __init__(self, window=240, max_frames=3600):
+        self.enabled = False
+        self.window = window
+        self.frames = deque(maxlen=max_frames)
+        self.recent = {}
+        self.frame = 0
+        self.origin = None
+        # the marks of the frame being timed, None outside of a timed frame
+        self.events = None
+        self.start = self.last = 0
+
+        self.font = None
+        self.overlay = []
+        self.overlay_every = 15
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.events = None
+        print(f'profiler {"on" if self.enabled else "off"}')
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self.start = self.last = time.perf_counter()
+        if self.origin is None:
+            self.origin = self.start
+        self.events = []
+
+    def mark(self, name):
+        if self.events is None:
+            return
+        now = time.perf_counter()
+        self.events.append((name, self.last, now - self.last))
+        self.last = now
+
+    def end(self, counts=None):
+        """ counts is a function returning the things worth counting, it's only called for timed frames """
+        if self.events is None:
+            return
+        stages = {}
+        for name, start, duration in self.events:
+            stages[name] = stages.get(name, 0) + duration
+        total = self.last - self.start
+        for name, duration in list(stages.items()) + [('frame', total)]:
+            recent = self.recent.get(name)
+            if recent is None:
+                recent = self.recent[name] = deque(maxlen=self.window)
+            recent.append(duration * 1000)
+        self.frames.append((self.frame, self.start, total, stages, self.events, counts() if counts else {}))
+        self.frame += 1
+        self.events = None
+
+    def percentiles(self):
+        """ stage -> (p50, p99) in milliseconds over the window """
+        return {name: tuple(np.percentile(recent, (50, 99)).tolist()) for name, recent in self.recent.items()}
+
+    def render(self, surf, pos=(4, 4)):
+        if not self.enabled or not self.frames:
+            return
+        # the text only changes a few times a second, rendering it is more work than timing the frame
+        if self.frame % self.overlay_every == 0 or not self.overlay:
+            if self.font is None:
+                self.font = pygame.font.SysFont('monospace', 14, True, False)
+            lines = [f'{"stage":<18}{"p50":>7}{"p99":>7}']
+            for name, (p50, p99) in sorted(self.percentiles().items(), key=lambda item: -item[1][1]):
+                lines.append(f'{name:<18}{p50:7.2f}{p99:7.2f}')
+            lines.append('  '.join(f'{name} {count}' for name, count in self.frames[-1][5].items()))
+            self.overlay = [self.font.render(line, True, (255, 255, 255), (0, 0, 0)) for line in lines]
+        y = pos[1]
+        for text in self.overlay:
+            surf.blit(text, (pos[0], y))
+            y += text.get_height()
+
+    def stage_names(self):
+        names = {}
+        for frame in self.frames:
+            names.update(dict.fromkeys(frame[3]))
+        return list(names)
+
+    def export_csv(self, path):
+        """ One row per frame, stage times in milliseconds followed by the counts """
+        stage_names = self.stage_names()
+        count_names = list({name: None for frame in self.frames for name in frame[5]})
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'start_ms', 'frame_ms'] + stage_names + count_names)
+            for frame, start, total, stages, events, counts in self.frames:
+                writer.writerow([frame, round((start - self.origin) * 1000, 3), round(total * 1000, 3)]
+                                + [round(stages.get(name, 0) * 1000, 3) for name in stage_names]
+                                + [counts.get(name, '') for name in count_names])
+
+    def export_trace(self, path):
+        """ Chrome trace-event json, every mark is a complete event and the counts are counters """
+        trace = []
+        for frame, start, total, stages, events, counts in self.frames:
+            trace.append({'name': 'frame', 'ph': 'X', 'pid': 0, 'tid': 0, 'args': {'frame': frame},
+                          'ts': (start - self.origin) * 1e6, 'dur': total * 1e6})
+            for name, event_start, duration in events:
+                trace.append({'name': name, 'cat': name.split('/')[0], 'ph': 'X', 'pid': 0, 'tid': 1,
+                              'ts': (event_start - self.origin) * 1e6, 'dur': duration * 1e6})
+            if counts:
+                trace.append({'name': 'counts', 'ph': 'C', 'pid': 0, 'ts': (start - self.origin) * 1e6, 'args': counts})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def export(self, name='profile'):
+        if not self.frames:
+            print('profiler has no frames to export')
+            return
+        self.export_csv(f'{name}.csv')
+        self.export_trace(f'{name}.json')
+        print(f'profiled {len(self.frames)} frames to {name}.csv and {name}.json')
@@ -0,0 +1,107 @@
+import math
+
+import numpy as np
+import pygame
+
+from scripts.effects import EffectPool
+
+
+class ProjectileSystem(EffectPool):
+    """ Projectiles in a fixed-size pool, moved and hit-tested for all of them at once
+
+    Each step is a segment from the last position to the new one, walls and entities are hit along
+    the whole segment so fast projectiles can't pass through anything. Muzzle and impact sparks all
+    go through burst().
+    """
+
+    def __init__(self, image, sparks, capacity=1024, lifetime=360, policy='drop_oldest', emitter_caps=None, rng=None):
+        super().__init__(capacity, policy, emitter_caps, rng=rng)
+        self.image = image
+        self.sparks = sparks
+        self.lifetime = lifetime
+        self.half_size = (image.get_width() / 2, image.get_height() / 2)
+        self.pos = np.zeros((capacity, 2))
+        self.last_pos = np.zeros((capacity, 2))
+        self.velocity = np.zeros((capacity, 2))
+        self.timer = np.zeros(capacity, dtype=np.int32)
+
+    def columns(self):
+        return super().columns() + (self.pos, self.last_pos, self.velocity, self.timer)
+
+    def burst(self, pos, angle, count, emitter='impact'):
+        for i in range(count):
+            self.sparks.spawn(pos, self.rng.random() - 0.5 + angle, 2 + self.rng.random(), emitter=emitter)
+
+    def spawn(self, pos, velocity, emitter='default', muzzle_sparks=4):
+        """ Returns False if the pool dropped the projectile """
+        i = self.reserve(emitter, pos)
+        if i is None:
+            return False
+        self.pos[i] = self.last_pos[i] = pos
+        self.velocity[i] = velocity
+        self.timer[i] = 0
+        self.burst(pos, math.atan2(velocity[1], velocity[0]), muzzle_sparks, emitter='shoot')
+        return True
+
+    def update(self, tilemap, impact_sparks=14):
+        """ Moves every projectile, the ones that hit a wall burst into sparks where they hit it """
+        n = self.count
+        if not n:
+            return
+        self.last_pos[:n] = self.pos[:n]
+        self.pos[:n] += self.velocity[:n]
+        self.timer[:n] += 1
+
+        hit, t = tilemap.sweep(self.last_pos[:n], self.pos[:n])
+        if hit.any():
+            last_pos, velocity = self.last_pos[:n][hit], self.velocity[:n][hit]
+            impacts = last_pos + velocity * t[hit, None]
+            for pos, (vx, vy) in zip(impacts.tolist(), velocity.tolist()):
+                self.burst(pos, math.atan2(vy, vx) + math.pi, impact_sparks)
+        self.remove(np.flatnonzero(hit | (self.timer[:n] > self.lifetime)))
+
+    def step_rects(self):
+        """ (serial, rect) for every projectile, the rect covering where its next step takes it """
+        n = self.count
+        start, end = self.pos[:n], self.pos[:n] + self.velocity[:n]
+        low = np.floor(np.minimum(start, end))
+        size = np.floor(np.maximum(start, end)) - low + 1
+        return [(serial, pygame.Rect(x, y, w, h))
+                for serial, (x, y), (w, h) in zip(self.serial[:n].tolist(), low.tolist(), size.tolist())]
+
+    def collide_rects(self, rects, candidates=None):
+        """ Removes the projectiles whose last step crossed any of rects, returns the indices of the rects hit
+
+        candidates limits the test to the projectiles with those serials, as found by the broadphase.
+        """
+        n = self.count
+        if not n or not rects:
+            return []
+        slots = np.arange(n) if candidates is None else np.flatnonzero(np.isin(self.serial[:n], candidates))
+        if not len(slots):
+            return []
+        start = self.last_pos[slots, None, :]
+        delta = (self.pos[slots] - self.last_pos[slots])[:, None, :]
+        low = np.array([(rect.left, rect.top) for rect in rects], dtype=np.float64)[None]
+        high = np.array([(rect.right, rect.bottom) for rect in rects], dtype=np.float64)[None]
+
+        # slab test of every segment against every rect, an axis without movement overlaps fully or not at all
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0, t1 = (low - start) / delta, (high - start) / delta
+        still = delta == 0
+        inside = (start >= low) & (start < high)
+        enter = np.where(still, np.where(inside, -np.inf, np.inf), np.minimum(t0, t1)).max(axis=2)
+        leave = np.where(still, np.where(inside, np.inf, -np.inf), np.maximum(t0, t1)).min(axis=2)
+        hits = (enter <= leave) & (enter <= 1) & (leave >= 0)
+
+        self.remove(slots[hits.any(axis=1)])
+        return np.flatnonzero(hits.any(axis=0)).tolist()
+
+    def render(self, surf, offset=(0, 0), alpha=1.0):
+        n = self.count
+        if not n:
+            return
+        last_pos = self.last_pos[:n]
+        render_pos = last_pos + (self.pos[:n] - last_pos) * alpha - offset - self.half_size
+        image = self.image
+        surf.blits([(image, pos) for pos in render_pos.tolist()], doreturn=False)
@@ -0,0 +1,149 @@
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+
+from scripts.batch import random_inputs
+from scripts.world import World, load_assets
+
+# magic, version, start level, seed, steps, sha1 of the final state as hex
+HEADER_V1 = struct.Struct('<4sHHQI40s')
+# version 2 adds the shake value and view size the world was made with
+HEADER = struct.Struct('<4sHHQI40sHHH')
+MAGIC = b'NJRP'
+VERSION = 2
+REPLAYS_DIR = 'data/replays/'
+
+# input byte -> input vector, bit i is input i
+INPUTS = [tuple((byte >> i) & 1 for i in range(4)) for byte in range(16)]
+
+
+class Recording:
+    """ The input of every simulation step of a session, a byte each, and a checksum of where it ended
+
+    With the start level, the seed and the settings of the world that's all it takes to play a session
+    again. The bytes are stored compressed, held directions repeat the same byte for seconds.
+    """
+
+    def __init__(self, level=0, seed=0, inputs=b'', checksum='', shake_value=16, view_size=(320, 180)):
+        self.level = level
+        self.seed = seed
+        self.inputs = bytearray(inputs)
+        self.checksum = checksum
+        self.shake_value = shake_value
+        self.view_size = tuple(int(size) for size in view_size)
+
+    def world(self, assets):
+        """ A fresh world in the state the recording starts from """
+        return World(assets, level_number=self.level, seed=self.seed, shake_value=self.shake_value, view_size=self.view_size)
+
+    def append(self, inputs):
+        self.inputs.append(sum(1 << i for i, value in enumerate(inputs) if value))
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __iter__(self):
+        for byte in self.inputs:
+            yield INPUTS[byte]
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.level, self.seed, len(self.inputs), self.checksum.encode(),
+                                self.shake_value, *self.view_size))
+            f.write(zlib.compress(bytes(self.inputs), 9))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, level, seed, steps, checksum = HEADER_V1.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a recording')
+        if version > VERSION:
+            raise ValueError(f'{path} has recording version {version}, newest supported is {VERSION}')
+        # version 1 recordings were all made with the world's default settings
+        header_size, shake_value, view_size = HEADER_V1.size, 16, (320, 180)
+        if version >= 2:
+            header_size = HEADER.size
+            shake_value, view_width, view_height = HEADER.unpack_from(data, 0)[6:]
+            view_size = (view_width, view_height)
+        inputs = zlib.decompress(data[header_size:])
+        if len(inputs) != steps:
+            raise ValueError(f'{path} should have {steps} steps but has {len(inputs)}')
+        return cls(level, seed, inputs, checksum.decode(), shake_value, view_size)
+
+
+def play(recording, assets):
+    """ Steps a fresh world through the recording, returns the world and the seconds it took """
+    start = time.perf_counter()
+    world = recording.world(assets)
+    for inputs in recording:
+        world.step(inputs)
+    return world, time.perf_counter() - start
+
+
+def record_scripted(assets, level, seed, frames):
+    """ A recording of a world played with the scripted input of the batch runner """
+    recording = Recording(level, seed)
+    world = recording.world(assets)
+    for inputs in random_inputs(random.Random(seed), frames):
+        recording.append(inputs)
+        world.step(inputs)
+    recording.checksum = world.checksum()
+    return recording
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded sessions headless, check their final state and time them')
+    parser.add_argument('paths', nargs='*', help=f'recordings, defaults to every one in {REPLAYS_DIR}')
+    parser.add_argument('--update', action='store_true', help='store the new checksums of recordings that no longer match')
+    parser.add_argument('--record', type=int, nargs='+', metavar='LEVEL',
+                        help=f'write new recordings of scripted play on these levels to {REPLAYS_DIR} instead')
+    parser.add_argument('--frames', type=int, default=3600, help='steps of a new recording')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first new recording, the others count up from it')
+    args = parser.parse_args(argv)
+
+    # nothing is shown or heard, but pygame shouldn't go looking for a display or sound card either
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    assets = load_assets()
+
+    if args.record:
+        os.makedirs(REPLAYS_DIR, exist_ok=True)
+        for i, level in enumerate(args.record):
+            path = f'{REPLAYS_DIR}{level}.rec'
+            record_scripted(assets, level, args.seed + i, args.frames).save(path)
+            print(f'recorded {args.frames} steps of level {level} to {path}')
+        return 0
+
+    paths = args.paths or sorted(REPLAYS_DIR + name for name in os.listdir(REPLAYS_DIR) if name.endswith('.rec'))
+    failed = 0
+    total_steps = total_seconds = 0
+    for path in paths:
+        recording = Recording.load(path)
+        world, seconds = play(recording, assets)
+        checksum = world.checksum()
+        total_steps += len(recording)
+        total_seconds += seconds
+        status = 'ok'
+        if checksum != recording.checksum:
+            if args.update:
+                recording.checksum = checksum
+                recording.save(path)
+                status = 'updated'
+            else:
+                status = f'MISMATCH {checksum} != {recording.checksum}'
+                failed += 1
+        print(f'{path}: {len(recording)} steps at {len(recording) / seconds:.0f} steps/s, {status}')
+
+    if total_seconds:
+        print(f'{len(paths)} replays, {total_steps} steps at {total_steps / total_seconds:.0f} steps/s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,38 +1,120 @@
 import math
-from random import randint
+from collections import OrderedDict
 
+import numpy as np
 import pygame
 
+from scripts.effects import EffectPool
 
-class Spark:
-    def __init__(self, pos, angle, speed, color=(255, 255, 255)):
-        self.pos = list(pos)
-        self.angle = angle
-        self.speed = speed
-        self.color = color
+ANGLE_STEPS = 64
+SPEED_STEP = 0.1
+COLOR_STEP = 32
+
+
+def spark_points(center, angle, speed):
+    return [
+        (center[0] + math.cos(angle) * speed * 3, center[1] + math.sin(angle) * speed * 3),
+        (center[0] + math.cos(angle + math.pi * 0.5) * speed * 0.5, center[1] + math.sin(angle + math.pi * 0.5) * speed * 0.5),
+        (center[0] + math.cos(angle + math.pi) * speed * 3, center[1] + math.sin(angle + math.pi) * speed * 3),
+        (center[0] + math.cos(angle - math.pi * 0.5) * speed * 0.5, center[1] + math.sin(angle - math.pi * 0.5) * speed * 0.5),
+    ]
+
+
+class SparkSystem(EffectPool):
+    """ Sparks in numpy arrays, drawn from pre-rasterized shapes bucketed by angle, speed and colour """
+
+    def __init__(self, capacity=2048, max_sprites=2048, max_new_sprites=64, policy='drop_oldest', emitter_caps=None, rng=None):
+        super().__init__(capacity, policy, emitter_caps, rng=rng)
+        self.colors = []
+        self.color_ids = {}
+        self.sprites = OrderedDict()
+        self.max_sprites = max_sprites
+        # past this many cache misses in a frame sparks are drawn directly, so bursts of new colours can't stall a frame
+        self.max_new_sprites = max_new_sprites
+        self.pos, self.direction = np.zeros((capacity, 2)), np.zeros((capacity, 2))
+        self.speed = np.zeros(capacity)
+        self.angle_id, self.color_id = np.zeros(capacity, dtype=np.int64), np.zeros(capacity, dtype=np.int64)
+
+    def columns(self):
+        return super().columns() + (self.pos, self.direction, self.speed, self.angle_id, self.color_id)
+
+    def color_index(self, color):
+        color = tuple(min(255, round(c / COLOR_STEP) * COLOR_STEP) for c in color[:3])
+        color_id = self.color_ids.get(color)
+        if color_id is None:
+            color_id = self.color_ids[color] = len(self.colors)
+            self.colors.append(color)
+        return color_id
+
+    def spawn(self, pos, angle, speed, color=(255, 255, 255), emitter='default'):
+        """ Returns False if the pool dropped the spark """
+        i = self.reserve(emitter, pos)
+        if i is None:
+            return False
+        self.pos[i] = pos
+        # the angle never changes so its direction is worked out once
+        self.direction[i] = (math.cos(angle), math.sin(angle))
+        self.speed[i] = speed
+        self.angle_id[i] = round(angle / (math.pi * 2) * ANGLE_STEPS) % ANGLE_STEPS
+        self.color_id[i] = self.color_index(color)
+        return True
 
     def update(self):
-        self.pos[0] += math.cos(self.angle) * self.speed
-        self.pos[1] += math.sin(self.angle) * self.speed
-
-        self.speed = max(0, self.speed - 0.1)
-        return not self.speed
-
-    def render(self, surf, offset=(0, 0)):
-        render_points = [
-            (self.pos[0] + math.cos(self.angle) * self.speed * 3 - offset[0],
-             self.pos[1] + math.sin(self.angle) * self.speed * 3 - offset[1]),
-            (self.pos[0] + math.cos(self.angle + math.pi * 0.5) * self.speed * 0.5 - offset[0],
-             self.pos[1] + math.sin(self.angle + math.pi * 0.5) * self.speed * 0.5 - offset[1]),
-            (self.pos[0] + math.cos(self.angle + math.pi) * self.speed * 3 - offset[0],
-             self.pos[1] + math.sin(self.angle + math.pi) * self.speed * 3 - offset[1]),
-            (self.pos[0] + math.cos(self.angle - math.pi * 0.5) * self.speed * 0.5 - offset[0],
-             self.pos[1] + math.sin(self.angle - math.pi * 0.5) * self.speed * 0.5 - offset[1]),
-        ]
-
-        # full random
-        #pygame.draw.polygon(surf, (randint(0, 255), randint(0, 100), randint(0, 55)), render_points)
-        # random more red
-        # pygame.draw.polygon(surf, (randint(0, 255), randint(0, 255), randint(0, 255)), render_points)
-        # white
-        pygame.draw.polygon(surf, self.color, render_points)
+        n = self.count
+        if not n:
+            return
+        speed = self.speed[:n]
+        self.pos[:n] += self.direction[:n] * speed[:, None]
+        np.maximum(speed - 0.1, 0, out=speed)
+        self.remove(np.flatnonzero(speed <= 0))
+
+    def sprite(self, key):
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+        angle_id, speed_id, color_id = key
+        speed = speed_id * SPEED_STEP
+        half = math.ceil(speed * 3) + 1
+        color = self.colors[color_id]
+        # solid shapes on a colorkey with RLE blit a lot faster than per-pixel alpha
+        colorkey = (0, 0, 0) if color != (0, 0, 0) else (255, 0, 255)
+        sprite = pygame.Surface((half * 2 + 1, half * 2 + 1))
+        sprite.fill(colorkey)
+        pygame.draw.polygon(sprite, color, spark_points((half, half), angle_id / ANGLE_STEPS * math.pi * 2, speed))
+        sprite.set_colorkey(colorkey, pygame.RLEACCEL)
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.max_sprites:
+            self.sprites.popitem(last=False)
+        return sprite
+
+    def sprite_keys(self):
+        n = self.count
+        speed_ids = np.rint(self.speed[:n] / SPEED_STEP).astype(np.int64)
+        return zip(self.angle_id[:n].tolist(), speed_ids.tolist(), self.color_id[:n].tolist()), speed_ids
+
+    def render(self, surf, offset=(0, 0), outline=None):
+        n = self.count
+        if not n:
+            return
+        keys, speed_ids = self.sprite_keys()
+        half = np.ceil(speed_ids * SPEED_STEP * 3) + 1
+        render_pos = self.pos[:n] - offset - half[:, None]
+        sprites, sprite = self.sprites, self.sprite
+        new_sprites = 0
+        blits = []
+        for key, pos, center in zip(keys, render_pos.tolist(), (self.pos[:n] - offset).tolist()):
+            if key not in sprites:
+                if new_sprites >= self.max_new_sprites:
+                    angle_id, speed_id, color_id = key
+                    points = spark_points(center, angle_id / ANGLE_STEPS * math.pi * 2, speed_id * SPEED_STEP)
+                    pygame.draw.polygon(surf, self.colors[color_id], points)
+                    if outline is not None:
+                        outline.add_polygon(points)
+                    continue
+                new_sprites += 1
+            blits.append((sprite(key), pos))
+        surf.blits(blits, doreturn=False)
+        if outline is not None:
+            for img, pos in blits:
+                outline.add(img, pos)
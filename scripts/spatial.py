@@ -0,0 +1,109 @@
+class SpatialHash:
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.item_cells = {}
+
+    def cell_range(self, rect):
+        size = self.cell_size
+        for cell_x in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cell_y in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                yield cell_x, cell_y
+
+    def insert(self, key, item, rect):
+        cells = list(self.cell_range(rect))
+        self.item_cells[key] = cells
+        for cell in cells:
+            bucket = self.cells.get(cell)
+            if bucket is None:
+                bucket = self.cells[cell] = {}
+            bucket[key] = item
+
+    def remove(self, key):
+        for cell in self.item_cells.pop(key, ()):
+            bucket = self.cells[cell]
+            del bucket[key]
+            if not bucket:
+                del self.cells[cell]
+
+    def query(self, rect):
+        """ Returns {key: item} for everything in the cells the rect touches """
+        found = {}
+        cells = self.cells
+        for cell in self.cell_range(rect):
+            bucket = cells.get(cell)
+            if bucket:
+                found.update(bucket)
+        return found
+
+    def clear(self):
+        self.cells.clear()
+        self.item_cells.clear()
+
+    def __len__(self):
+        return len(self.item_cells)
+
+
+# how far things can move in a frame after the broadphase is built, their rects are grown by this much
+MOVE_MARGINS = {'player': 9, 'enemy': 6}
+
+
+class Broadphase:
+    """ A SpatialHash of the player, the enemies and the projectiles, rebuilt every frame
+
+    Entries are keyed (kind, key). Rects are grown by MOVE_MARGINS so pairs found at the start of a frame
+    still hold after everything has moved, callers do the exact test on the candidates they get back.
+    """
+
+    def __init__(self, cell_size=32):
+        self.hash = SpatialHash(cell_size)
+        self.rects = {}
+
+    def add(self, kind, key, item, rect):
+        margin = MOVE_MARGINS.get(kind, 0)
+        if margin:
+            rect = rect.inflate(margin * 2, margin * 2)
+        self.hash.insert((kind, key), item, rect)
+        self.rects[(kind, key)] = rect
+
+    def remove_kind(self, kind):
+        for key in [key for key in self.rects if key[0] == kind]:
+            self.hash.remove(key)
+            del self.rects[key]
+
+    def rebuild(self, player, enemies):
+        self.hash.clear()
+        self.rects.clear()
+        self.add('player', 0, player, player.rect())
+        for enemy in enemies:
+            self.add('enemy', id(enemy), enemy, enemy.rect())
+
+    def add_projectiles(self, projectiles):
+        """ Projectiles go in right before they move, as the rects of their next step """
+        self.remove_kind('projectile')
+        for serial, rect in projectiles.step_rects():
+            self.add('projectile', serial, serial, rect)
+
+    def query(self, rect, kind=None):
+        """ Items of kind whose rects overlap rect """
+        rects = self.rects
+        return [item for key, item in self.hash.query(rect).items()
+                if (kind is None or key[0] == kind) and rects[key].colliderect(rect)]
+
+    def pairs(self, kind_a, kind_b):
+        """ (a, b) for every item of kind_a whose rect overlaps one of kind_b """
+        rects = self.rects
+        found = {}
+        for bucket in self.hash.cells.values():
+            items_a = [(key, item) for key, item in bucket.items() if key[0] == kind_a]
+            if not items_a:
+                continue
+            items_b = [(key, item) for key, item in bucket.items() if key[0] == kind_b]
+            for key_a, item_a in items_a:
+                for key_b, item_b in items_b:
+                    if (key_a, key_b) not in found and rects[key_a].colliderect(rects[key_b]):
+                        found[(key_a, key_b)] = (item_a, item_b)
+        return list(found.values())
+
+    def __len__(self):
+        return len(self.rects)
@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+from collections import OrderedDict
+
+from scripts.grid import CHUNK_SHIFT, CHUNK_SIZE
+from scripts.map_format import MAP_KEYS, MapFile, read_json_map, read_map, write_map
+from scripts.migrations import migrate
+
+# a region file holds REGION_SIZE x REGION_SIZE chunks
+REGION_SIZE = 16
+WORLD_FILE = 'world.json'
+
+
+def region_path(world_dir, region_loc):
+    return os.path.join(world_dir, f'{region_loc[0]}_{region_loc[1]}.map')
+
+
+class ChunkStreamer:
+    """ Keeps the chunks around the camera loaded from the region files of a world directory
+
+    Chunks are read on a background thread and handed to the grid on the main thread in update(),
+    until then they count as empty for rendering and collisions.
+    """
+
+    def __init__(self, grid, world_dir, tile_size=16, region_size=REGION_SIZE, radius=3, max_open_regions=8):
+        self.grid = grid
+        self.world_dir = world_dir
+        self.tile_size = tile_size
+        self.region_size = region_size
+        self.radius = radius
+        self.max_open_regions = max_open_regions
+
+        # chunk locs that are loaded or known to be empty
+        self.loaded = set()
+        self.requested = set()
+        self.center = None
+        self.luts = {}
+
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.regions = OrderedDict()
+        self.running = True
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def open_region(self, region_loc):
+        """ Returns the MapFile of a region or None if the world has no file for it """
+        if region_loc in self.regions:
+            self.regions.move_to_end(region_loc)
+            return self.regions[region_loc]
+        path = region_path(self.world_dir, region_loc)
+        region = MapFile(path) if os.path.exists(path) else None
+        self.regions[region_loc] = region
+        if len(self.regions) > self.max_open_regions:
+            old_region = self.regions.popitem(last=False)[1]
+            if old_region is not None:
+                old_region.close()
+        return region
+
+    def read_chunk(self, chunk_loc):
+        region_loc = (chunk_loc[0] // self.region_size, chunk_loc[1] // self.region_size)
+        with self.lock:
+            region = self.open_region(region_loc)
+            if region is None or chunk_loc not in region.chunks:
+                return chunk_loc, None
+            ids, rotations = region.chunk_arrays(chunk_loc)
+        return chunk_loc, (region_loc, region.palette, ids, rotations, region.chunks[chunk_loc][0])
+
+    def work(self):
+        while True:
+            chunk_loc = self.requests.get()
+            if chunk_loc is None:
+                break
+            self.results.put(self.read_chunk(chunk_loc))
+        with self.lock:
+            for region in self.regions.values():
+                if region is not None:
+                    region.close()
+            self.regions.clear()
+
+    def add(self, chunk_loc, data):
+        self.requested.discard(chunk_loc)
+        self.loaded.add(chunk_loc)
+        if data is None:
+            return
+        region_loc, palette, ids, rotations, count = data
+        # the palette of an open region never changes so its lut can be reused
+        lut = self.luts.get(region_loc)
+        if lut is None or lut[0] is not palette:
+            lut = self.luts[region_loc] = (palette, self.grid.palette_lut(palette))
+        self.grid.add_chunk(chunk_loc, ids, rotations, lut[1], count)
+
+    def chunks_around(self, center_chunk):
+        return {(x, y) for x in range(center_chunk[0] - self.radius, center_chunk[0] + self.radius + 1)
+                for y in range(center_chunk[1] - self.radius, center_chunk[1] + self.radius + 1)}
+
+    def is_loaded(self, chunk_loc):
+        return chunk_loc in self.loaded
+
+    def center_chunk(self, pos):
+        return int(pos[0] // self.tile_size) >> CHUNK_SHIFT, int(pos[1] // self.tile_size) >> CHUNK_SHIFT
+
+    def load_around(self, pos):
+        """ Loads everything in range of pos right away, for level starts and respawns """
+        for chunk_loc in self.chunks_around(self.center_chunk(pos)) - self.loaded - self.requested:
+            self.add(*self.read_chunk(chunk_loc))
+        self.center = None
+        self.update(pos)
+
+    def update(self, pos):
+        while True:
+            try:
+                self.add(*self.results.get_nowait())
+            except queue.Empty:
+                break
+
+        center = self.center_chunk(pos)
+        if center == self.center:
+            return
+        self.center = center
+
+        wanted = self.chunks_around(center)
+        for chunk_loc in wanted - self.loaded - self.requested:
+            self.requested.add(chunk_loc)
+            self.requests.put(chunk_loc)
+
+        # chunks are kept a little past the radius so walking back and forth doesn't reload them
+        keep = self.radius + 2
+        for chunk_loc in list(self.loaded):
+            if abs(chunk_loc[0] - center[0]) > keep or abs(chunk_loc[1] - center[1]) > keep:
+                self.loaded.discard(chunk_loc)
+                self.grid.unload(chunk_loc)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.requests.put(None)
+
+
+def split_map(map_path, world_dir, region_size=REGION_SIZE):
+    """ Splits a json or binary map into the region files of a streamed world """
+    map_data = read_map(map_path) if map_path.endswith('.map') else read_json_map(map_path)
+    migrate(map_data)
+    os.makedirs(world_dir, exist_ok=True)
+
+    region_px = region_size * CHUNK_SIZE
+    regions = {}
+    for loc, tile in map_data['tilemap'].items():
+        region_loc = (tile['pos'][0] // region_px, tile['pos'][1] // region_px)
+        regions.setdefault(region_loc, {})[loc] = tile
+
+    for region_loc, tiles in regions.items():
+        write_map(region_path(world_dir, region_loc), {'tilemap': tiles,
+                                                       'tile_size': map_data['tile_size'],
+                                                       'offgrid': [],
+                                                       'offgrid_hover_tiles': []})
+
+    # offgrid tiles are few enough to be loaded with the world up front
+    world_data = {key: value for key, value in map_data.items() if key != 'tilemap'}
+    world_data['region_size'] = region_size
+    with open(os.path.join(world_dir, WORLD_FILE), 'w') as f:
+        json.dump(world_data, f)
+
+    print(f'Split {map_path} into {len(regions)} regions in {world_dir}')
+
+
+def read_world(world_dir):
+    with open(os.path.join(world_dir, WORLD_FILE), 'r') as f:
+        world_data = json.load(f)
+    # worlds split before world.json had a version only need their offgrid layers and meta upgraded,
+    # the region files are binary maps and those store every tile's rotation
+    world_data['tilemap'] = {}
+    migrate(world_data)
+    del world_data['tilemap']
+    for key in MAP_KEYS:
+        if key != 'tilemap' and key not in world_data:
+            raise ValueError(f'{world_dir} is missing {key}')
+    return world_data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split a map into region files for streaming')
+    parser.add_argument('map', help='.json or .map file to split')
+    parser.add_argument('world_dir', help='directory to write world.json and the region files to')
+    parser.add_argument('--region-size', type=int, default=REGION_SIZE, help='region width and height in chunks')
+    args = parser.parse_args(argv)
+    split_map(args.map, args.world_dir, args.region_size)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
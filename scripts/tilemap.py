@@ -1,7 +1,20 @@
 import json
+import math
+import os
+from collections import OrderedDict
 
+import numpy as np
 import pygame
 
+from scripts.collision import CollisionLayer
+from scripts.grid import CHUNK_SHIFT, CHUNK_SIZE, TileGrid, GridView
+from scripts.map_format import MapFile, read_map, write_map
+from scripts.migrations import MAP_VERSION, map_version, migrate, needs_tiles
+from scripts.outline import outline, silhouette
+from scripts.spatial import SpatialHash
+from scripts.streaming import ChunkStreamer, read_world
+from scripts.utils import RotationCache
+
 AUTOTILE_MAP = {
     tuple(sorted([(1, 0), (0, 1)])): 0,
     tuple(sorted([(1, 0), (0, 1), (-1, 0)])): 1,
@@ -15,118 +28,366 @@ AUTOTILE_MAP = {
 
 }
 
-NEIGHBOR_OFFSETS = [(0, 0), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1)]
+# neighbour bits used by the bulk autotile pass
+AUTOTILE_BITS = {(1, 0): 1, (-1, 0): 2, (0, 1): 4, (0, -1): 8}
+AUTOTILE_VARIANTS = np.full(16, -1, dtype=np.int16)
+for neighbors, autotile_variant in AUTOTILE_MAP.items():
+    AUTOTILE_VARIANTS[sum(AUTOTILE_BITS[shift] for shift in neighbors)] = autotile_variant
+
 PHYSICS_TILES = {'grass', 'stone'}
 AUTOTILE_TYPES = {'grass', 'stone'}
 
 
+class OffgridLayer:
+    """ Ordered list of offgrid tiles with a spatial index for culling and picking """
+
+    def __init__(self, tilemap, tiles=()):
+        self.tilemap = tilemap
+        # insertion key -> tile, keys grow so sorting them keeps the drawing order
+        self.tiles = {}
+        self.keys = {}
+        # (type, variant) -> {key: tile}
+        self.by_id = {}
+        self.next_key = 0
+        self.index = SpatialHash(cell_size=64)
+        for tile in tiles:
+            self.append(tile)
+
+    def tile_rect(self, tile):
+        if tile['type'] in self.tilemap.game.assets:
+            width, height = self.tilemap.tile_images.get(tile['type'], tile['variant'], tile['rotation']).get_size()
+        else:
+            width = height = self.tilemap.tile_size
+        return pygame.Rect(math.floor(tile['pos'][0]), math.floor(tile['pos'][1]), width + 1, height + 1)
+
+    def append(self, tile):
+        key = self.next_key
+        self.next_key += 1
+        self.tiles[key] = tile
+        self.keys[id(tile)] = key
+        self.by_id.setdefault((tile['type'], tile['variant']), {})[key] = tile
+        self.index.insert(key, tile, self.tile_rect(tile))
+
+    def remove(self, tile):
+        key = self.keys.pop(id(tile))
+        del self.tiles[key]
+        del self.by_id[(tile['type'], tile['variant'])][key]
+        self.index.remove(key)
+
+    def matching(self, id_pairs):
+        found = {}
+        for id_pair in id_pairs:
+            found.update(self.by_id.get(id_pair, {}))
+        return [found[key] for key in sorted(found)]
+
+    def query(self, rect):
+        found = self.index.query(rect)
+        return [found[key] for key in sorted(found)]
+
+    def at(self, pos):
+        return [tile for tile in self.query(pygame.Rect(math.floor(pos[0]), math.floor(pos[1]), 1, 1))
+                if self.tile_rect(tile).collidepoint(pos)]
+
+    def __iter__(self):
+        return iter(list(self.tiles.values()))
+
+    def __len__(self):
+        return len(self.tiles)
+
+
 class Tilemap:
     def __init__(self, game, tile_size=16):
         self.game = game
         self.tile_size = tile_size
-        self.tilemap = {}
-        self.offgrid_tiles = []
-        self.offgrid_hover_tiles = []
+        self.grid = TileGrid(PHYSICS_TILES)
+        self.tilemap = GridView(self.grid)
+        self.collision = CollisionLayer(self.grid, tile_size)
+        self.streamer = None
+        self.tile_images = RotationCache(game.assets)
+        self.offgrid_tiles = OffgridLayer(self)
+        self.offgrid_hover_tiles = OffgridLayer(self)
+        # chunk loc -> [chunk version, baked surface, outline, silhouette], the last two made when first drawn
+        self.chunk_surfaces = OrderedDict()
+        self.max_chunk_surfaces = 128
+        # chunks the last rendered view can show, the cache always holds at least those
+        self.visible_chunks = 0
 
     def extract(self, id_pairs, keep=False):
         matches = []
-        for tile in self.offgrid_tiles.copy():
-            if (tile['type'], tile['variant']) in id_pairs:
-                matches.append(tile.copy())
-                if not keep:
-                    self.offgrid_tiles.remove(tile)
-                    
-        for loc in self.tilemap:
-            tile = self.tilemap[loc]
-            if (tile['type'], tile['variant']) in id_pairs:
-                matches.append(tile.copy())
-                matches[-1]['pos'] = matches[-1]['pos'].copy()
-                matches[-1]['pos'][0] *= self.tile_size
-                matches[-1]['pos'][1] *= self.tile_size
-                if not keep:
-                    del self.tilemap[loc]
+        for tile in self.offgrid_tiles.matching(id_pairs):
+            matches.append(tile.copy())
+            if not keep:
+                self.offgrid_tiles.remove(tile)
+
+        tile_ids = [self.grid.palette_ids[pair] for pair in id_pairs if pair in self.grid.palette_ids]
+        for x, y, tile_id, rotation in self.grid.find(tile_ids):
+            tile_type, variant = self.grid.palette[tile_id]
+            matches.append({'type': tile_type, 'variant': variant,
+                            'pos': [x * self.tile_size, y * self.tile_size], 'rotation': rotation})
+            if not keep:
+                self.grid.remove(x, y)
 
         return matches
 
-    def tiles_around(self, pos):
-        tiles = []
-        tile_loc = (int(pos[0] // self.tile_size), int(pos[1] // self.tile_size))
-        for offset in NEIGHBOR_OFFSETS:
-            check_loc = str(tile_loc[0] + offset[0]) + ';' + str(tile_loc[1] + offset[1])
-            if check_loc in self.tilemap:
-                tiles.append(self.tilemap[check_loc])
+    def solid_check(self, pos):
+        return self.grid.is_solid(int(pos[0] // self.tile_size), int(pos[1] // self.tile_size))
 
-        return tiles
+    def sweep(self, start, end):
+        """ Casts segments from start to end points through the grid, both (n, 2) arrays in pixels
 
-    def solid_check(self, pos):
-        tile_loc = str(int(pos[0] // self.tile_size)) + ';' + str(int(pos[1] // self.tile_size))
-        if tile_loc in self.tilemap:
-            if self.tilemap[tile_loc]['type'] in PHYSICS_TILES:
-                return self.tilemap[tile_loc]
+        Every tile a segment passes through is tested, so fast movers can't skip over thin walls.
+        Returns (hit, t), t being how far along its segment each one enters its first solid tile.
+        """
+        start, end = np.asarray(start, dtype=np.float64), np.asarray(end, dtype=np.float64)
+        n = len(start)
+        delta = end - start
+        cell = np.floor(start / self.tile_size).astype(np.int64)
+        steps = np.floor(end / self.tile_size).astype(np.int64) - cell
+        sign = np.sign(steps)
+        k = int(np.abs(steps).max(initial=0))
+
+        # the times tile borders are crossed on each axis, the nth border past the start cell is cell + n*sign (+1 going forward)
+        j = np.arange(k)[None, :, None]
+        borders = (cell[:, None, :] + j * sign[:, None, :] + (sign[:, None, :] > 0)) * self.tile_size
+        with np.errstate(divide='ignore', invalid='ignore'):
+            times = (borders - start[:, None, :]) / delta[:, None, :]
+        times[j >= np.abs(steps)[:, None, :]] = np.inf
+        times = times.transpose(0, 2, 1).reshape(n, 2 * k)
+        order = np.argsort(times, axis=1, kind='stable')
+        times = np.take_along_axis(times, order, axis=1)
+        axis = np.repeat([0, 1], k)[order]
+
+        # walk the crossings in order to get every visited cell, the start cell comes first
+        xs = np.concatenate([cell[:, :1], cell[:, :1] + np.cumsum((axis == 0) * sign[:, :1], axis=1)], axis=1)
+        ys = np.concatenate([cell[:, 1:], cell[:, 1:] + np.cumsum((axis == 1) * sign[:, 1:], axis=1)], axis=1)
+        times = np.concatenate([np.zeros((n, 1)), times], axis=1)
+        visited = np.isfinite(times)
+
+        solid = np.zeros(times.shape, dtype=bool)
+        solid[visited] = self.grid.solid_cells(xs[visited], ys[visited])
+        hit = solid.any(axis=1)
+        t = np.where(hit, times[np.arange(n), np.argmax(solid, axis=1)], 1.0)
+        return hit, t
 
     def physics_rects_around(self, pos):
-        rects = []
-        for tile in self.tiles_around(pos):
-            if tile['type'] in PHYSICS_TILES:
-                rect_x, rect_y = tile['pos'][0] * self.tile_size, tile['pos'][1] * self.tile_size
-                rect_size = (self.tile_size, self.tile_size)
-                rects.append(pygame.Rect(rect_x, rect_y, *rect_size))
-        return rects
+        return self.collision.rects_around(int(pos[0] // self.tile_size), int(pos[1] // self.tile_size))
 
-    def autotile(self):
-        for loc in self.tilemap:
-            tile = self.tilemap[loc]
+    def loaded_around(self, pos):
+        """ False while a chunk that physics_rects_around(pos) reads from is still streaming in """
+        if self.streamer is None:
+            return True
+        tile_x, tile_y = int(pos[0] // self.tile_size), int(pos[1] // self.tile_size)
+        return all(self.streamer.is_loaded((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))
+                   for x in (tile_x - 1, tile_x + 1) for y in (tile_y - 1, tile_y + 1))
+
+    def set_tile(self, x, y, tile_type, variant, rotation=0):
+        self.grid.set(x, y, tile_type, variant, rotation)
+        self.autotile_around(x, y)
+
+    def remove_tile(self, x, y):
+        if self.grid.remove(x, y):
+            self.autotile_around(x, y)
+            return True
+        return False
+
+    def autotile_around(self, x, y):
+        self.autotile_cells([(x, y)] + [(x + shift[0], y + shift[1]) for shift in AUTOTILE_BITS])
+
+    def autotile_cells(self, cells):
+        grid = self.grid
+        for x, y in cells:
+            tile = grid.tile(x, y)
+            if tile is None or tile[0] not in AUTOTILE_TYPES:
+                continue
             neighbors = set()
-            for shift in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
-                check_loc = f"{tile['pos'][0] + shift[0]};{tile['pos'][1] + shift[1]}"
-                if check_loc in self.tilemap:
-                    if self.tilemap[check_loc]['type'] == tile['type']:
-                        neighbors.add(shift)
+            for shift in AUTOTILE_BITS:
+                neighbor_id = grid.get(x + shift[0], y + shift[1])
+                if neighbor_id and grid.palette[neighbor_id][0] == tile[0]:
+                    neighbors.add(shift)
             neighbors = tuple(sorted(neighbors))
-            if (tile['type'] in AUTOTILE_TYPES) and (neighbors in AUTOTILE_MAP):
-                tile['variant'] = AUTOTILE_MAP[neighbors]
+            if neighbors in AUTOTILE_MAP:
+                grid.set(x, y, tile[0], AUTOTILE_MAP[neighbors], tile[2])
+
+    def autotile(self):
+        """ Autotiles the whole grid in one pass over a dense copy of it """
+        grid = self.grid
+        grid.decode_all()
+        if not grid.chunks:
+            return
+
+        left = min(chunk_loc[0] for chunk_loc in grid.chunks)
+        top = min(chunk_loc[1] for chunk_loc in grid.chunks)
+        width = (max(chunk_loc[0] for chunk_loc in grid.chunks) - left + 1) * CHUNK_SIZE
+        height = (max(chunk_loc[1] for chunk_loc in grid.chunks) - top + 1) * CHUNK_SIZE
+
+        # one empty cell of border so every tile has four neighbours to compare with
+        ids = np.zeros((height + 2, width + 2), dtype=np.uint16)
+        for (chunk_x, chunk_y), chunk in grid.chunks.items():
+            x, y = (chunk_x - left) * CHUNK_SIZE + 1, (chunk_y - top) * CHUNK_SIZE + 1
+            ids[y:y + CHUNK_SIZE, x:x + CHUNK_SIZE] = np.frombuffer(chunk.ids, dtype=np.uint16).reshape(CHUNK_SIZE, CHUNK_SIZE)
+
+        type_names = sorted({tile_type for tile_type, variant in grid.palette[1:]})
+        type_index = np.array([0] + [type_names.index(key[0]) + 1 for key in grid.palette[1:]], dtype=np.int32)
+        types = type_index[ids]
+        center = types[1:-1, 1:-1]
+        mask = ((types[1:-1, 2:] == center) * AUTOTILE_BITS[(1, 0)]
+                | (types[1:-1, :-2] == center) * AUTOTILE_BITS[(-1, 0)]
+                | (types[2:, 1:-1] == center) * AUTOTILE_BITS[(0, 1)]
+                | (types[:-2, 1:-1] == center) * AUTOTILE_BITS[(0, -1)])
+        variants = AUTOTILE_VARIANTS[mask]
+
+        autotile_types = np.array([False] + [name in AUTOTILE_TYPES for name in type_names])
+        update = autotile_types[center] & (variants >= 0)
+        if not update.any():
+            return
+
+        # palette id of every (type, autotile variant) that can come out of the pass
+        new_id = np.zeros((len(type_names) + 1, int(AUTOTILE_VARIANTS.max()) + 1), dtype=np.uint16)
+        for i, name in enumerate(type_names):
+            if name in AUTOTILE_TYPES:
+                for variant in AUTOTILE_MAP.values():
+                    new_id[i + 1, variant] = grid.tile_id(name, variant)
+        new_ids = np.where(update, new_id[center, np.maximum(variants, 0)], ids[1:-1, 1:-1])
+
+        for chunk_x, chunk_y in list(grid.chunks):
+            x, y = (chunk_x - left) * CHUNK_SIZE, (chunk_y - top) * CHUNK_SIZE
+            grid.write_ids((chunk_x, chunk_y), new_ids[y:y + CHUNK_SIZE, x:x + CHUNK_SIZE])
+
+    def render(self, surf, offset=(0, 0), outline=None):
+        view_rect = pygame.Rect(offset, surf.get_size())
 
-    def render(self, surf, offset=(0, 0)):
-        for tile in self.offgrid_tiles:
-            asset = self.game.assets[tile['type']]
-            tile_img = pygame.transform.rotate(asset[tile['variant']], tile['rotation'])
+        for tile in self.offgrid_tiles.query(view_rect):
+            tile_img = self.tile_images.get(tile['type'], tile['variant'], tile['rotation'])
             render_pos = (tile['pos'][0] - offset[0], tile['pos'][1] - offset[1])
             surf.blit(tile_img, render_pos)
+            if outline is not None:
+                outline.add(tile_img, render_pos)
 
-        for x in range(offset[0] // self.tile_size, (offset[0] + surf.get_width()) // self.tile_size + 1):
-            for y in range(offset[1] // self.tile_size, (offset[1] + surf.get_height()) // self.tile_size + 1):
-                loc = f"{x};{y}"
-                if loc in self.tilemap:
-                    tile = self.tilemap[loc]
-                    asset = self.game.assets[tile['type']]
-                    tile_img = pygame.transform.rotate(asset[tile['variant']], tile['rotation'])
-                    render_pos = (tile['pos'][0] * self.tile_size - offset[0], tile['pos'][1] * self.tile_size - offset[1])
-                    surf.blit(tile_img, render_pos)
-
-        for tile in self.offgrid_hover_tiles:
-            asset = self.game.assets[tile['type']]
-            tile_img = pygame.transform.rotate(asset[tile['variant']], tile['rotation'])
+        chunk_px = CHUNK_SIZE * self.tile_size
+        self.visible_chunks = (surf.get_width() // chunk_px + 2) * (surf.get_height() // chunk_px + 2)
+        for chunk_x in range(offset[0] // chunk_px, (offset[0] + surf.get_width()) // chunk_px + 1):
+            for chunk_y in range(offset[1] // chunk_px, (offset[1] + surf.get_height()) // chunk_px + 1):
+                chunk_surf = self.chunk_surface((chunk_x, chunk_y))
+                if chunk_surf is not None:
+                    render_pos = (chunk_x * chunk_px - offset[0], chunk_y * chunk_px - offset[1])
+                    surf.blit(chunk_surf, render_pos)
+                    if outline is not None:
+                        outline.add_baked(*self.chunk_outline((chunk_x, chunk_y), outline.shadow is not None), render_pos)
+
+        for tile in self.offgrid_hover_tiles.query(view_rect):
+            tile_img = self.tile_images.get(tile['type'], tile['variant'], tile['rotation'])
             render_pos = (tile['pos'][0] - offset[0], tile['pos'][1] - offset[1])
             surf.blit(tile_img, render_pos)
+            if outline is not None:
+                outline.add(tile_img, render_pos)
+
+    def chunk_surface(self, chunk_loc):
+        chunk = self.grid.chunk(chunk_loc)
+        if chunk is None:
+            return None
+        baked = self.chunk_surfaces.get(chunk_loc)
+        if baked is not None and baked[0] == chunk.version:
+            self.chunk_surfaces.move_to_end(chunk_loc)
+            return baked[1]
+
+        # rotated tiles can stick out of their cell so the surface gets one extra tile of room
+        size = (CHUNK_SIZE + 1) * self.tile_size
+        chunk_surf = pygame.Surface((size, size), pygame.SRCALPHA)
+        base_x, base_y = chunk_loc[0] << CHUNK_SHIFT, chunk_loc[1] << CHUNK_SHIFT
+        for x, y, tile_id, rotation in self.grid.chunk_tiles(chunk_loc):
+            tile_img = self.tile_images.get(*self.grid.palette[tile_id], rotation)
+            chunk_surf.blit(tile_img, ((x - base_x) * self.tile_size, (y - base_y) * self.tile_size))
+
+        self.chunk_surfaces[chunk_loc] = [chunk.version, chunk_surf, None, None]
+        self.chunk_surfaces.move_to_end(chunk_loc)
+        while len(self.chunk_surfaces) > max(self.max_chunk_surfaces, self.visible_chunks):
+            self.chunk_surfaces.popitem(last=False)
+        return chunk_surf
+
+    def chunk_outline(self, chunk_loc, shadow=False):
+        """ (outline, silhouette) of a baked chunk, they live and go with the baked surface """
+        baked = self.chunk_surfaces[chunk_loc]
+        if baked[2] is None:
+            baked[2] = outline(baked[1])
+        if shadow and baked[3] is None:
+            baked[3] = silhouette(baked[1])
+        return baked[2], baked[3]
 
     def save(self, path):
-        with open(path, 'w') as f:
-            map_data = {'tilemap': self.tilemap,
-                        'tile_size': self.tile_size,
-                        'offgrid': self.offgrid_tiles,
-                        'offgrid_hover_tiles': self.offgrid_hover_tiles}
-            json.dump(map_data, f)
+        map_data = {'version': MAP_VERSION,
+                    'tilemap': dict(self.tilemap),
+                    'tile_size': self.tile_size,
+                    'offgrid': list(self.offgrid_tiles),
+                    'offgrid_hover_tiles': list(self.offgrid_hover_tiles)}
+        if os.path.splitext(path)[1] == '.map':
+            write_map(path, map_data)
+        else:
+            with open(path, 'w') as f:
+                json.dump(map_data, f)
 
         print(f'Saved tilemap to {path}')
 
     def load(self, path):
-        with open(path, 'r') as f:
-            map_data = json.load(f)
+        self.stop_streaming()
+        self.grid.clear()
+        map_data = None
+        if os.path.splitext(path)[1] == '.map':
+            map_file = MapFile(path)
+            if not needs_tiles(map_version(map_file.meta)):
+                # the migrations only touch the offgrid layers and meta, the chunks stay lazy
+                layers = {'tilemap': {}, 'tile_size': map_file.tile_size,
+                          'offgrid': map_file.offgrid_tiles, 'offgrid_hover_tiles': map_file.offgrid_hover_tiles}
+                layers.update(map_file.meta)
+                migrate(layers)
+                self.grid.attach(map_file)
+                self.tile_size = map_file.tile_size
+                offgrid_tiles, offgrid_hover_tiles = layers['offgrid'], layers['offgrid_hover_tiles']
+            else:
+                # binary maps older than a migration that changes tiles are read whole so it can see every tile
+                map_file.close()
+                map_data = read_map(path)
+        else:
+            with open(path, 'r') as f:
+                map_data = json.load(f)
 
-        self.tilemap = map_data['tilemap']
-        self.tile_size = map_data['tile_size']
-        self.offgrid_tiles = map_data['offgrid']
-        self.offgrid_hover_tiles = map_data['offgrid_hover_tiles']
+        if map_data is not None:
+            migrate(map_data)
+            for tile in map_data['tilemap'].values():
+                self.grid.set(tile['pos'][0], tile['pos'][1], tile['type'], tile['variant'], tile['rotation'])
+            self.tile_size = map_data['tile_size']
+            offgrid_tiles, offgrid_hover_tiles = map_data['offgrid'], map_data['offgrid_hover_tiles']
+
+        self.reset_layers(offgrid_tiles, offgrid_hover_tiles)
+
+        # binary maps decode their chunks lazily, those fill the cache as they get baked
+        if not self.grid.pending:
+            self.tile_images.warm(self.grid.palette[tile_id] + (rotation,) for x, y, tile_id, rotation in self.grid)
+        self.tile_images.warm((tile['type'], tile['variant'], tile['rotation'])
+                              for layer in (self.offgrid_tiles, self.offgrid_hover_tiles) for tile in layer)
 
         print(f'Loaded tilemap from {path}')
 
+    def load_world(self, world_dir, radius=3):
+        """ Starts streaming the chunks of a world directory written by scripts.streaming """
+        self.stop_streaming()
+        self.grid.clear()
+        world_data = read_world(world_dir)
+        self.tile_size = world_data['tile_size']
+        self.streamer = ChunkStreamer(self.grid, world_dir, self.tile_size, world_data['region_size'], radius)
+        self.reset_layers(world_data['offgrid'], world_data['offgrid_hover_tiles'])
+        self.tile_images.warm((tile['type'], tile['variant'], tile['rotation'])
+                              for layer in (self.offgrid_tiles, self.offgrid_hover_tiles) for tile in layer)
+
+        print(f'Streaming world from {world_dir}')
+
+    def stop_streaming(self):
+        if self.streamer is not None:
+            self.streamer.stop()
+            self.streamer = None
+
+    def reset_layers(self, offgrid_tiles, offgrid_hover_tiles):
+        self.collision.rebuild(self.tile_size)
+        self.tile_images.clear()
+        self.chunk_surfaces.clear()
+        self.offgrid_tiles = OffgridLayer(self, offgrid_tiles)
+        self.offgrid_hover_tiles = OffgridLayer(self, offgrid_hover_tiles)
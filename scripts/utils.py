@@ -1,11 +1,19 @@
-import pygame
 import os
+import random
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import pygame
 
 BASE_IMG_PATH = "data/images/"
 
 
 def load_image(path):
-    img = pygame.image.load(BASE_IMG_PATH + path).convert()
+    img = pygame.image.load(BASE_IMG_PATH + path)
+    # converting needs a display, headless worlds keep the image in its file format
+    if pygame.display.get_surface() is not None:
+        img = img.convert()
     img.set_colorkey((0, 0, 0))
     return img
 
@@ -17,26 +25,107 @@ def load_images(path):
     return images
 
 
-class Animation:
+def flip_pair(img):
+    """ (img, img mirrored horizontally), indexed with an entity's flip """
+    return img, pygame.transform.flip(img, True, False)
+
+
+class AnimationClip:
+    """ Frames and timing of an animation, shared by everything that plays it and never changed after loading """
+    __slots__ = ('images', 'flipped_images', 'img_duration', 'loop', 'length')
+
     def __init__(self, images, img_dur=5, loop=True):
-        self.images = images
-        self.img_duration = img_dur
-        self.loop = loop
+        set_attr = super().__setattr__
+        set_attr('images', tuple(images))
+        # mirrored once here so rendering a flipped entity doesn't allocate a surface every frame
+        set_attr('flipped_images', tuple(flip_pair(img)[1] for img in images))
+        set_attr('img_duration', img_dur)
+        set_attr('loop', loop)
+        set_attr('length', img_dur * len(images))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'AnimationClip is immutable, tried to set {name}')
+
+    def play(self):
+        return AnimationCursor(self)
+
+
+class AnimationCursor:
+    """ Where an entity is in an AnimationClip, switching clips reuses the same cursor """
+    __slots__ = ('clip', 'frame', 'done')
+
+    def __init__(self, clip=None):
+        self.clip = clip
+        self.frame = 0
         self.done = False
+
+    def start(self, clip):
+        self.clip = clip
         self.frame = 0
-        
-    def copy(self):
-        return Animation(self.images, self.img_duration, self.loop)
+        self.done = False
 
     def update(self):
-        if self.loop:
-            self.frame = (self.frame + 1) % (self.img_duration * len(self.images))
+        clip = self.clip
+        if clip.loop:
+            self.frame = (self.frame + 1) % clip.length
         else:
-            self.frame = min(self.frame + 1, self.img_duration * len(self.images) - 1)
-            if self.frame >= self.img_duration * len(self.images) - 1:
+            self.frame = min(self.frame + 1, clip.length - 1)
+            if self.frame >= clip.length - 1:
                 self.done = True
 
-    def img(self):
-        return self.images[int(self.frame / self.img_duration)]
+    def img(self, flip=False):
+        clip = self.clip
+        return (clip.flipped_images if flip else clip.images)[self.frame // clip.img_duration]
+
+
+class RotationCache:
+    def __init__(self, assets, max_size=256):
+        self.assets = assets
+        self.max_size = max_size
+        self.images = OrderedDict()
+
+    def get(self, tile_type, variant, rotation=0):
+        key = (tile_type, variant, rotation)
+        img = self.images.get(key)
+        if img is None:
+            img = self.assets[tile_type][variant]
+            if rotation:
+                img = pygame.transform.rotate(img, rotation)
+            self.images[key] = img
+            # dropping the least recently used rotation
+            if len(self.images) > self.max_size:
+                self.images.popitem(last=False)
+        else:
+            self.images.move_to_end(key)
+        return img
+
+    def warm(self, keys):
+        for tile_type, variant, rotation in set(keys):
+            # the game has no images for editor-only tiles like spawners
+            if tile_type in self.assets:
+                self.get(tile_type, variant, rotation)
+
+    def clear(self):
+        self.images.clear()
+
+
+class RandomStreams:
+    """ A separate random generator for every subsystem, all derived from one seed
+
+    With a stream each, what one subsystem draws can't shift the numbers another one gets, so the
+    screenshake of a rendered frame never changes where the next leaf falls. Without a seed the
+    streams are seeded from the OS.
+    """
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.streams = {}
 
+    def __getitem__(self, name):
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = self.streams[name] = random.Random(None if self.seed is None else f'{self.seed}/{name}')
+        return stream
 
+    def numpy(self, name):
+        return np.random.default_rng(None if self.seed is None else [self.seed, zlib.crc32(name.encode())])
@@ -0,0 +1,253 @@
+import hashlib
+import os
+import random
+
+import pygame
+
+from scripts.entities import Player, Enemy
+from scripts.enemy_ai import EnemyController
+from scripts.particle import ParticleSystem
+from scripts.profiler import FrameProfiler
+from scripts.projectile import ProjectileSystem
+from scripts.spark import SparkSystem
+from scripts.spatial import Broadphase
+from scripts.tilemap import Tilemap
+from scripts.utils import load_image, load_images, flip_pair, AnimationClip, RandomStreams
+
+MAPS_DIR = 'data/maps/'
+
+# indexes of the input vector a step takes: held left, held right, jump pressed, dash pressed
+LEFT, RIGHT, JUMP, DASH = range(4)
+NO_INPUT = (0, 0, 0, 0)
+
+
+def load_assets():
+    """ Every image the simulation and the game need, loads without a display too """
+    return {
+        'decor': load_images('tiles/decor'),
+        'grass': load_images('tiles/grass'),
+        'large_decor': load_images('tiles/large_decor'),
+        'stone': load_images('tiles/stone'),
+        'player': load_image('entities/player.png'),
+        'background': load_image('background.png'),
+        'clouds': load_images('clouds'),
+        'player/idle': AnimationClip(load_images('entities/player/idle'), 6),
+        'player/run': AnimationClip(load_images('entities/player/run'), 4),
+        'player/jump': AnimationClip(load_images('entities/player/jump')),
+        'player/slide': AnimationClip(load_images('entities/player/slide')),
+        'player/wall_slide': AnimationClip(load_images('entities/player/wall_slide')),
+        'particle/leaf': AnimationClip(load_images('particles/leaf'), img_dur=20, loop=False),
+        'particle/particle': AnimationClip(load_images('particles/particle'), img_dur=6, loop=False),
+        'enemy/idle': AnimationClip(load_images('entities/enemy/idle'), img_dur=6),
+        'enemy/run': AnimationClip(load_images('entities/enemy/run'), img_dur=4),
+        'gun': flip_pair(load_image('gun.png')),
+        'projectile': load_image('projectile.png'),
+    }
+
+
+def level_count():
+    return len({os.path.splitext(name)[0] for name in os.listdir(MAPS_DIR)})
+
+
+class World:
+    """ The whole simulation: the level, the player, the enemies, projectiles and effects
+
+    It needs no display or audio. step() advances it by one fixed step with an input vector, sounds it
+    would play are collected in `sounds` for whoever presents the world to play and clear.
+
+    Everything random in it draws from the streams of `rng`, so a world with the same seed, level and
+    inputs plays out the same every time. Without a seed one is picked and kept in `seed`.
+    """
+
+    def __init__(self, assets, level_number=0, view_size=(320, 180), shake_value=16, streaming=False, stream_radius=3, seed=None):
+        self.assets = assets
+        self.view_size = view_size
+        self.shake_value = shake_value
+        self.sounds = []
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.rng = RandomStreams(self.seed)
+
+        # effect pools never grow, the celebration burst every frame at the end of a level just recycles its own slots
+        self.particles = ParticleSystem({'leaf': self.assets['particle/leaf'], 'particle': self.assets['particle/particle']},
+                                        capacity=2048, emitter_caps={'dying': 900, 'leaf': 300}, rng=self.rng['particles'])
+        self.sparks = SparkSystem(capacity=2048, emitter_caps={'dying': 900}, rng=self.rng['sparks'])
+        self.projectiles = ProjectileSystem(self.assets['projectile'], self.sparks, capacity=1024, rng=self.rng['projectiles'])
+
+        self.enemy_ai = EnemyController(self, self.rng.numpy('enemy_ai'))
+        self.broadphase = Broadphase()
+        # disabled unless whoever runs the world enables it or hands in its own
+        self.profiler = FrameProfiler()
+
+        self.movement = [False, False]
+        self.player = Player(self, (50, 50), (8, 15))
+        self.tilemap = Tilemap(self, tile_size=16)
+
+        # streamed levels are read from data/worlds/<level>/ around the camera instead of loaded whole
+        self.streaming = streaming
+        self.stream_radius = stream_radius
+
+        self.frame = 0
+        self.deaths = 0
+        self.levels_completed = 0
+        self.level_number = level_number
+        self.load_level()
+
+        self.screenshake = 0
+
+    def play_sound(self, name):
+        self.sounds.append(name)
+
+    def load_level(self):
+        map_id = self.level_number
+        # binary maps load faster, the json version is the fallback
+        path = f"{MAPS_DIR}{map_id}.map"
+        if not os.path.exists(path):
+            path = f"{MAPS_DIR}{map_id}.json"
+        try:
+            if self.streaming:
+                self.tilemap.load_world(f"data/worlds/{map_id}", radius=self.stream_radius)
+            else:
+                self.tilemap.load(path)
+        except FileNotFoundError:
+            print('Map was not Found')
+        self.leaf_spawners = []
+        for tree in self.tilemap.extract(id_pairs=[('large_decor', 2)], keep=True):
+            self.leaf_spawners.append(pygame.Rect(4 + tree['pos'][0], 4 + tree['pos'][1], 23, 13))
+
+        self.enemies = []
+        for spawner in self.tilemap.extract(id_pairs=[('spawners', 0), ('spawners', 1)]):
+            if spawner['variant'] == 0:
+                self.player.pos = spawner['pos']
+            else:
+                self.enemies.append(Enemy(self, spawner['pos'], (8, 15)))
+
+        self.projectiles.clear()
+        self.particles.clear()
+        self.sparks.clear()
+        self.is_playing_salute = False
+
+        #self.scroll = [-112, -30]
+        self.scroll = [self.player.pos[0] - 162, self.player.pos[1] - 82]
+        self.last_scroll = list(self.scroll)
+        self.player.last_pos = list(self.player.pos)
+        if self.tilemap.streamer:
+            self.tilemap.streamer.load_around(self.camera_center())
+        self.dead = 0
+        self.transition = -30
+
+    def camera_center(self):
+        return self.scroll[0] + self.view_size[0] / 2, self.scroll[1] + self.view_size[1] / 2
+
+    def step(self, inputs=NO_INPUT):
+        """ Advances the simulation by one fixed step, inputs is (left, right, jump, dash) """
+        self.frame += 1
+        self.screenshake = max(0, self.screenshake - 1)
+
+        if not self.enemies:
+            rng = self.rng['celebration']
+            self.player.dying(color=(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+            self.transition += 0.13
+            if not self.is_playing_salute:
+                self.play_sound('salute')
+                self.play_sound('salute_and_song')
+                self.is_playing_salute = True
+            if self.transition > 30:
+                self.levels_completed += 1
+                self.level_number = (self.level_number + 1) % level_count()
+                self.load_level()
+        if self.transition < 0:
+            self.transition += 1
+
+        if self.dead:
+            self.dead += 1
+            if self.dead >= 10:
+                self.transition = min(30, self.transition + 1)
+            if self.dead > 40:
+                self.deaths += 1
+                self.load_level()
+                self.player.respawn()
+                self.profiler.mark('step/level')
+                return
+        else:
+            # input is ignored until the player respawns
+            self.movement[0], self.movement[1] = bool(inputs[LEFT]), bool(inputs[RIGHT])
+            if inputs[JUMP] and self.player.jump():
+                self.play_sound('jump')
+            if inputs[DASH]:
+                self.player.dash()
+
+        self.last_scroll[:] = self.scroll
+        self.scroll[0] += (self.player.rect().centerx - self.view_size[0] / 2 - self.scroll[0]) / 30
+        self.scroll[1] += (self.player.rect().centery - self.view_size[1] / 2 - self.scroll[1]) / 30
+
+        if self.tilemap.streamer:
+            self.tilemap.streamer.update(self.camera_center())
+
+        view = pygame.Rect((int(self.scroll[0]), int(self.scroll[1])), self.view_size)
+        self.particles.view = self.sparks.view = self.projectiles.view = view
+
+        rng = self.rng['leaves']
+        for rect in self.leaf_spawners:
+            if rng.random() * 49999 < rect.width * rect.height:
+                pos = (rect.x + rng.random() * rect.width, rect.y + rng.random() * rect.height)
+                velocity = [round(rng.uniform(-0.3, 0.3), 2), round(rng.uniform(0.1, 0.5), 2)]
+                frame = rng.randint(0, len(self.assets['particle/leaf'].images))
+                self.particles.spawn('leaf', pos, velocity, frame, emitter='leaf')
+        self.profiler.mark('step/level')
+
+        self.broadphase.rebuild(self.player, self.enemies)
+        near_player = {id(enemy) for enemy, player in self.broadphase.pairs('enemy', 'player')}
+        # enemies wait where they are until the ground around them has streamed in, or they'd fall through it
+        active = [enemy for enemy in self.enemies if self.tilemap.loaded_around(enemy.pos)]
+        if len(active) != len(self.enemies):
+            for enemy in self.enemies:
+                if enemy not in active:
+                    enemy.last_pos = list(enemy.pos)
+        for enemy, movement in zip(active, self.enemy_ai.update(active, self.tilemap)):
+            if enemy.update(self.tilemap, movement, id(enemy) in near_player):
+                self.enemies.remove(enemy)
+        self.profiler.mark('step/enemies')
+
+        if not self.dead:
+            self.player.update(self.tilemap, (self.movement[1] - self.movement[0], 0))
+        self.profiler.mark('step/player')
+
+        self.broadphase.add_projectiles(self.projectiles)
+        self.projectiles.update(self.tilemap)
+        incoming = [serial for serial, player in self.broadphase.pairs('projectile', 'player')]
+        if abs(self.player.dashing) < 50 and not self.dead and self.projectiles.collide_rects([self.player.rect()], incoming):
+            self.play_sound('hit')
+            self.dead += 1
+            self.player.dying()
+            self.screenshake = max(16, self.screenshake)
+        self.profiler.mark('step/projectiles')
+
+        self.sparks.update()
+        self.particles.update()
+        self.profiler.mark('step/effects')
+
+    def checksum(self):
+        """ Hash of the state a replay has to reproduce exactly
+
+        The camera is left out, it follows the view size and nothing in the simulation depends on it.
+        """
+        player = self.player
+        state = [self.frame, self.level_number, self.deaths, self.levels_completed, self.dead, self.transition,
+                 self.screenshake, player.pos, player.velocity, player.dashing, player.air_time, player.jumps,
+                 [(enemy.pos, enemy.velocity, enemy.flip, enemy.walking) for enemy in self.enemies]]
+        digest = hashlib.sha1(repr(state).encode())
+        for pool in (self.projectiles, self.sparks, self.particles):
+            for array in pool.columns():
+                digest.update(array[:pool.count].tobytes())
+        return digest.hexdigest()
+
+    def result(self):
+        """ A summary of the run so far, for batch runs """
+        return {'level': self.level_number,
+                'seed': self.seed,
+                'frames': self.frame,
+                'deaths': self.deaths,
+                'levels_completed': self.levels_completed,
+                'enemies_left': len(self.enemies),
+                'player_pos': [round(self.player.pos[0], 2), round(self.player.pos[1], 2)],
+                'checksum': self.checksum()}